@@ -13,115 +13,248 @@ Therefore, only normalized locations (at 1m distance from camera) are used.
 """
 import os
 import os.path
+import shutil
 import time
-from math import radians, cos, sin, sqrt
 import numpy as np
-from scipy.cluster.hierarchy import linkage, fcluster
 
+from src import metrics
+from src.detections import (DetectedObjects, camera_object_pairs, detected_objects,
+                            group_cameras, num_objects, read_detections, take_objects)
+from src.edge_store import (build_graph_on_disk, closest_edges_on_disk, edge_mask_on_disk,
+                            edge_sources_on_disk, intersection_edges_on_disk,
+                            matching_classes_on_disk, prune_graph_on_disk, viable_edges_on_disk)
 from src.geometry import euclidean_distance
+from src.graph import (IntersectionGraph, build_graph, closest_edges, edge_sources,
+                       graph_components, intersection_edges, matching_classes, prune_graph,
+                       subgraph, viable_edges)
+from src.spatial_index import camera_pairs, single_linkage_clusters
+from src.stage_cache import cache_key, cached_stage
+from src.voting import ray_voting
 
 # Input and output CSV files
 INPUT_FILE = "data/postprocessing_output/bicycle_symbols_example.csv"
 OUTPUT_FILE = "output/bicycle_symbols_example.csv"
 
+# Localization engine: "mrf" for the MRF-based triangulation or "voting" for the fast ray
+# voting, e.g. for previews and QA of a new mission
+ENGINE = "mrf"
+
 # Preset parameters
 MAX_DST_CAM_OBJECT = 15  # Max distance from camera to objects (in meters)
 MAX_CLUSTER_SIZE = 1  # Maximal size of clusters employed (in meters)
+INTERSECTION_BATCH_SIZE = 1000000  # Number of candidate pairs intersected at once
+MIN_INTERSECTION_ANGLE = 0  # Min angle between two intersecting lines (in degrees, 0 disables)
+MAX_OBJECT_INTERSECTIONS = None  # Keep the intersections that are among the closest ones of
+                                 # both objects, this many per object (None disables)
 
 # MRF optimization parameters
-ICM_ITERATIONS = 15  # Number of iterations for ICM
+ICM_ITERATIONS = 15  # Number of iterations for ICM (max number of sweeps for the "sweep" schedule)
+ICM_SCHEDULE = "random"  # "random" proposals over all objects, "sweep" over the viable objects or
+                         # "colored" for vectorized sweeps over independent sets of edges
+ICM_TOLERANCE = 0.001  # Stop sweeping once at most this fraction of the viable objects changed
+ICM_SEED = None  # Seed of the ICM proposals (None seeds from the current time)
 DEPTH_WEIGHT = 0.2  # weight alpha in Eq.(4)
 OBJECT_MULTIVIEW = 0.2  # weight beta in  Eq.(4)
 STANDALONE_PRICE = max(1 - DEPTH_WEIGHT - OBJECT_MULTIVIEW,
                       0)  # weight (1-alpha-beta) in Eq. (4)
+ICM_WORKERS = 1  # Number of processes optimizing independent connected components (1 disables)
+ICM_TASK_SIZE = 10000  # Minimal number of objects in the components of one worker task
+
+# Ray voting parameters
+VOTING_CELL_SIZE = 0.5  # Size of the square cells of the voting grid (in meters)
+VOTING_MIN_VIEWS = 2  # Min number of cameras that vote for an object
+
+# Tiled processing of city-scale inputs
+TILE_SIZE = None  # Size of the square tiles in RD-coordinates (in meters, None disables)
+TILE_HALO = MAX_DST_CAM_OBJECT * 640 / 256  # Overlap of the objects used by neighboring tiles,
+                                            # the reach of a line (in meters)
+TILE_FOLDER = "output/tiles/"  # Folder for the results of the finished tiles of a run
+
+# Out-of-core graph of the intersections, for inputs of which the edges do not fit in memory
+EDGE_STORE_FOLDER = None  # Folder for the memory-mapped graph and its edge indexes (None keeps
+                          # them in memory)
+EDGE_CHUNK_SIZE = 10000000  # Number of edges sorted at once in EDGE_STORE_FOLDER
+
+# Folder for the intermediate results, reused by reruns on the same input (None disables)
+CACHE_FOLDER = "cache/"
+
+def ray_directions(objects_base):
+    """
+    Get the direction of the line from the camera to every detected object,
+    the normalized object location relative to the camera location
+    """
+    return objects_base.x_norm - objects_base.x, objects_base.y_norm - objects_base.y
+
 
-def intersection_point(object_1, object_2):
+def intersection_points(objects_base, object_1, object_2, rays=None):
     """
-    Calculating the intersection point between two lines
-    Specified each by camera location and depth-estimated object location
+    Calculating the intersection points between pairs of lines at once, for index
+    arrays object_1 and object_2 of the detected objects. Each line is specified
+    by the camera location and the normalized object location, the directions
+    can be passed precomputed as rays. Failed intersections get the error codes
+    in x and y: -1 for parallel lines, -2 for a negative depth and -3 for a
+    depth that is out of range.
     """
+    if rays is None:
+        rays = ray_directions(objects_base)
+    ray_x, ray_y = rays
 
-    # The camera locations (index 4 and 5) and the object locations (index 0 and 1)
-    a_1 = object_1[0] - object_1[4]
-    b_1 = object_2[0] - object_2[4]
-    c_1 = object_2[4] - object_1[4]
+    cam_x_1, cam_y_1 = objects_base.x[object_1], objects_base.y[object_1]
+    cam_x_2, cam_y_2 = objects_base.x[object_2], objects_base.y[object_2]
 
-    a_2 = object_1[1] - object_1[5]
-    b_2 = object_2[1] - object_2[5]
-    c_2 = object_2[5] - object_1[5]
+    a_1 = ray_x[object_1]
+    b_1 = ray_x[object_2]
+    c_1 = cam_x_2 - cam_x_1
 
-    if a_2 * b_1 - b_2 * a_1:
-        y = (a_1 * c_2 - a_2 * c_1) / (a_2 * b_1 - b_2 * a_1)
-    else:
-        return -1, -1, 0, 0
-    if a_1 != 0:
-        x = (b_1 * y + c_1) / a_1
-    else:
-        x = (b_2 * y + c_2) / a_2
+    a_2 = ray_y[object_1]
+    b_2 = ray_y[object_2]
+    c_2 = cam_y_2 - cam_y_1
 
-    if x < 0 or y < 0:
-        return -2, -2, 0, 0
-    if x > MAX_DST_CAM_OBJECT or y > MAX_DST_CAM_OBJECT:
-        return -3, -3, 0, 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denominator = a_2 * b_1 - b_2 * a_1
+        parallel = denominator == 0
+        y = (a_1 * c_2 - a_2 * c_1) / denominator
+        x = np.where(a_1 != 0, (b_1 * y + c_1) / a_1, (b_2 * y + c_2) / a_2)
 
-    # Calculate the intersection point
-    x_intersect, y_intersect = a_1 * x + object_1[4], a_2 * x + object_1[5]
+        negative = ~parallel & ((x < 0) | (y < 0))
+        out_of_range = ~parallel & ~negative & ((x > MAX_DST_CAM_OBJECT)
+                                                | (y > MAX_DST_CAM_OBJECT))
+        failed = parallel | negative | out_of_range
+
+        # Calculate the intersection points
+        x_intersect = np.where(failed, 0., a_1 * x + cam_x_1)
+        y_intersect = np.where(failed, 0., a_2 * x + cam_y_1)
+
+    for mask, error in ((parallel, -1.), (negative, -2.), (out_of_range, -3.)):
+        x[mask] = error
+        y[mask] = error
 
     return x, y, x_intersect, y_intersect
 
 
-def calc_energy(object_dst, objects_base, objects_connectivity, object_1):
+def state_energy(state):
     """
-    Calculate the MRF energy of an intersection
+    Calculate the MRF energy of an intersection from the running state of its
+    object: the number of links, the weighted sum of the depth deviations and
+    the min and max link depths
     """
-    inters = np.count_nonzero(objects_connectivity[object_1, :])
-    if inters == 0:
+    link_count, depth_deviation, dpthmin, dpthmax = state
+    if link_count == 0:
         return STANDALONE_PRICE
-    energy = 0
-    dpthmin, dpthmax = 1000, 0
-    for i in range(len(objects_base)):
-        if objects_connectivity[object_1, i]:
-            dpth_temp = DEPTH_WEIGHT * abs(object_dst[object_1, i]
-                                        - objects_base[object_1][3])
-            energy += dpth_temp
-            dpth = object_dst[object_1, i]
-            if dpth < dpthmin:
-                dpthmin = dpth
-            if dpth > dpthmax:
-                dpthmax = dpth
-    return energy + OBJECT_MULTIVIEW * (dpthmax - dpthmin)
-
-
-def avg_object_location(intersects, objects_connectivity, object_1):
+    return depth_deviation + OBJECT_MULTIVIEW * (dpthmax - dpthmin)
+
+
+def toggle_state(graph, objects_base, objects_connectivity, state, object_1, edge):
+    """
+    Get the running MRF state of an object after toggling one of its links. This
+    takes O(1), except when removing the link with the min or max depth, which
+    rescans the links of the object.
+    """
+    link_count, depth_deviation, dpthmin, dpthmax = state
+    dpth = float(graph.dst[edge])
+    dpth_temp = DEPTH_WEIGHT * abs(dpth - objects_base.depth[object_1])
+
+    # Add a link
+    if not objects_connectivity[edge]:
+        if link_count == 0:
+            return 1, dpth_temp, dpth, dpth
+        return link_count + 1, depth_deviation + dpth_temp, min(dpthmin, dpth), max(dpthmax, dpth)
+
+    # Remove a link
+    if link_count == 1:
+        return 0, 0., 1000., 0.
+    if dpthmin < dpth < dpthmax:
+        return link_count - 1, depth_deviation - dpth_temp, dpthmin, dpthmax
+
+    start, end = graph.indptr[object_1], graph.indptr[object_1 + 1]
+    linked = objects_connectivity[start:end] > 0
+    linked[edge - start] = False
+    dpth_rest = graph.dst[start:end][linked]
+    return link_count - 1, depth_deviation - dpth_temp, float(dpth_rest.min()), float(dpth_rest.max())
+
+
+def states_energy(link_count, depth_deviation, dpthmin, dpthmax):
+    """
+    Vectorized state_energy for arrays of running states
+    """
+    return np.where(link_count == 0, STANDALONE_PRICE,
+                    depth_deviation + OBJECT_MULTIVIEW * (dpthmax - dpthmin))
+
+
+def toggle_states(graph, objects_base, objects_connectivity, state, objects, edges):
+    """
+    Vectorized toggle_state for arrays of different objects and one edge of
+    each, with the running states as a tuple of arrays
+    """
+    link_count, depth_deviation, dpthmin, dpthmax = state
+    dpth = graph.dst[edges]
+    dpth_temp = DEPTH_WEIGHT * np.abs(dpth - objects_base.depth[objects])
+
+    # Add or remove a link
+    add = objects_connectivity[edges] == 0
+    new_count = np.where(add, link_count + 1, link_count - 1)
+    new_deviation = np.where(add, depth_deviation + dpth_temp, depth_deviation - dpth_temp)
+    new_min = np.where(add, np.minimum(dpthmin, dpth), dpthmin)
+    new_max = np.where(add, np.maximum(dpthmax, dpth), dpthmax)
+
+    empty = new_count == 0
+    new_deviation[empty], new_min[empty], new_max[empty] = 0., 1000., 0.
+
+    # Removing the link with the min or max depth rescans the links of the object
+    rescan = np.flatnonzero(~add & ~empty & ((dpth <= dpthmin) | (dpth >= dpthmax)))
+    if len(rescan):
+        new_min[rescan], new_max[rescan] = linked_depth_range(
+            graph, objects_connectivity, objects[rescan], edges[rescan])
+
+    return new_count, new_deviation, new_min, new_max
+
+
+def linked_depth_range(graph, objects_connectivity, objects, edges):
+    """
+    Get the min and max depth of the links of every object, except one of its
+    edges, for objects that have at least one other link
+    """
+    starts, ends = graph.indptr[objects], graph.indptr[objects + 1]
+    degrees = ends - starts
+    offsets = np.zeros(len(objects) + 1, dtype=np.int64)
+    np.cumsum(degrees, out=offsets[1:])
+
+    # Positions of the edges of all rows of the objects, in order
+    positions = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], degrees)
+    linked = (objects_connectivity[positions] > 0) & (positions != np.repeat(edges, degrees))
+    dst = graph.dst[positions]
+
+    return (np.minimum.reduceat(np.where(linked, dst, np.inf), offsets[:-1]),
+            np.maximum.reduceat(np.where(linked, dst, -np.inf), offsets[:-1]))
+
+
+def avg_object_location(graph, objects_connectivity, object_1):
     """
     Calculate the averaged object location (used after clustering)
     """
-    res = np.zeros(2)
-    cnt = 0
-    for i in range(intersects.shape[0]):
-        if objects_connectivity[object_1, i]:
-            res[:] += intersects[object_1, i, :]
-            cnt += 1
-    if cnt:
-        return res / cnt
-    return res
+    start, end = graph.indptr[object_1], graph.indptr[object_1 + 1]
+    linked = objects_connectivity[start:end] > 0
+    if linked.any():
+        return graph.points[start:end][linked].mean(axis=0)
+    return np.zeros(2)
 
 
 def hierarchical_cluster(intersects, max_intra_degree_dst):
     """
-    Hierarchical clustering
+    Hierarchical clustering (single linkage), with a spatial index so time and
+    memory grow near-linearly with the number of intersections
     """
-    Z = linkage(np.asarray(intersects))
-    clusters = fcluster(Z, max_intra_degree_dst, criterion="distance") - 1
+    intersects = np.asarray(intersects, dtype=float).reshape(-1, 2)
+    clusters = single_linkage_clusters(intersects, max_intra_degree_dst)
     num_clusters = max(clusters) + 1
-    cluster_intersections = np.zeros((num_clusters, 3))
-    for i in range(len(intersects)):
-        cluster_intersections[clusters[i], 0] += intersects[i][0]
-        cluster_intersections[clusters[i], 1] += intersects[i][1]
-        cluster_intersections[clusters[i], 2] += 1
+    cluster_intersections = np.column_stack((
+        np.bincount(clusters, weights=intersects[:, 0], minlength=num_clusters),
+        np.bincount(clusters, weights=intersects[:, 1], minlength=num_clusters),
+        np.bincount(clusters, minlength=num_clusters)))
     return cluster_intersections
 
 
+@metrics.stage("read_inputfile")
 def read_inputfile():
     """
     Read the input CSV file that defines a detected object by four values of
@@ -129,187 +262,556 @@ def read_inputfile():
     clockwise in degrees towards the object in the panoramic image and the
     depth estimate. The latter may be omitted or set to zero.
     """
-    objects_base = []
-
-    with open(INPUT_FILE, "r") as f:
-        next(f)  # skip the first line
-        for line in f:
-            nums = line.split(",")
-            if len(nums) < 3:
-                print("Broken entry ignored")
-                continue
-            if len(nums) < 4:  # if a depth estimate is not available
-                (x, y, viewpoint_to_object, depth) = (float(nums[0]),
-                                              float(nums[1]), float(nums[2]), 5)
-            else:
-                (x, y, viewpoint_to_object, depth) = (float(nums[0]),
-                                              float(nums[1]), float(nums[2]), float(nums[3]))
-            if depth <= 0:
-                depth = 5
-
-            # Calculating the object locations using
-            # camera location + viewpoint_to_object + depth_estimate
-            br1 = radians(180 + viewpoint_to_object)
-            x_object = x + (depth * sin(br1) * 640 / 256) # depth-based locations
-            y_object = y + (depth * cos(br1) * 640 / 256)
-            # Normalized locations (at 1m distance from camera)
-            x_object_norm = x + (1.0 * sin(br1) * 640 / 256)
-            y_object_norm = y + (1.0 * cos(br1) * 640 / 256)
-
-            objects_base.append((
-                x_object_norm,
-                y_object_norm,
-                viewpoint_to_object, # not used
-                depth,
-                x,
-                y,
-                x_object,   # not used, see NOTE at the top
-                y_object   # not used, see NOTE at the top
-            ))
-
-    print("All detected objects: {0:d}".format(len(objects_base)))
+    x, y, viewpoint_to_object, depth, malformed = read_detections(INPUT_FILE)
+    if malformed:
+        print("Broken entries ignored: {0:d} (lines {1}{2})".format(
+            len(malformed), ", ".join(map(str, malformed[:10])),
+            ", ..." if len(malformed) > 10 else ""))
+
+    objects_base = detected_objects(x, y, viewpoint_to_object, depth)
+
+    print("All detected objects: {0:d}".format(num_objects(objects_base)))
+    metrics.record("detections", num_objects(objects_base))
+    metrics.record("malformed", len(malformed))
 
     return objects_base
 
+@metrics.stage("get_all_intersections")
 def get_all_intersections(objects_base):
     """
-    Get the RD-coordinates of the pairwise intersections
+    Get the RD-coordinates of the pairwise intersections, stored as a sparse graph
+    of the admissible intersections, in memory or in EDGE_STORE_FOLDER
+    """
+    batches = admissible_intersections(objects_base)
+
+    if EDGE_STORE_FOLDER:
+        return build_graph_on_disk(os.path.join(EDGE_STORE_FOLDER, "graph"),
+                                   num_objects(objects_base), batches, EDGE_CHUNK_SIZE)
+
+    pairs, dst_1, dst_2, points = [], [], [], []
+    for batch_pairs, batch_dst_1, batch_dst_2, batch_points in batches:
+        pairs.append(batch_pairs)
+        dst_1.append(batch_dst_1)
+        dst_2.append(batch_dst_2)
+        points.append(batch_points)
+
+    if not pairs:
+        return build_graph(num_objects(objects_base), [], [], [], [])
+    return build_graph(num_objects(objects_base), np.concatenate(pairs), np.concatenate(dst_1),
+                       np.concatenate(dst_2), np.concatenate(points))
+
+def admissible_intersections(objects_base):
+    """
+    Generate the admissible intersections in batches of the object pairs, their
+    distances to the intersection from both cameras and the intersection points
     """
-    intersections = []
     num_intersections = 0
-    object_dst = np.zeros((len(objects_base), len(objects_base)))
-    intersections = np.zeros((len(objects_base), len(objects_base), 2))
 
     # Maximum distance between the two camera locations observing the same object
     max_cam_dst = 1.5 * MAX_DST_CAM_OBJECT
 
-    # Nested loop, looping over all initial locations of panoramic images,
-    # checking which one are close to each other
-    for i in range(len(objects_base)):
+    # The detected objects of one panoramic image share their camera location,
+    # so the candidate pairs are found on the unique camera locations with a
+    # spatial index and then expanded to the pairs of their detected objects.
+    # Pairs of the same panoramic image are excluded this way.
+    cameras = group_cameras(objects_base)
+    cam_pairs, _ = camera_pairs(cameras.x, cameras.y,
+                                0.5, max_cam_dst) # NOTE maybe set this to 1m
+    rays = ray_directions(objects_base)
+
+    # Split the camera pairs into batches of about INTERSECTION_BATCH_SIZE object pairs
+    counts = np.diff(cameras.indptr)
+    num_pairs = np.cumsum(counts[cam_pairs[:, 0]] * counts[cam_pairs[:, 1]])
+    total = int(num_pairs[-1]) if len(num_pairs) else 0
+    bounds = np.searchsorted(num_pairs, np.arange(INTERSECTION_BATCH_SIZE, total,
+                                                  INTERSECTION_BATCH_SIZE), side="right")
+    bounds = np.concatenate(([0], bounds, [len(cam_pairs)]))
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            continue
         # An update to the user
-        if i % 1000 == 0 and i > 0:
-            print("Parced {} object entries ({:.2f}%)".format(i, 100.
-                                                              * i / len(objects_base)))
-
-        # Set an error value when identical panoramic image
-        object_dst[i, i] = -5
-
-        # Only pairwise intersections
-        for j in range(i + 1, len(objects_base)):
-            # Calculate distance between two panoramic images in meters
-            cam_dst = euclidean_distance(objects_base[i][5], objects_base[i][4],
-                                            objects_base[j][5], objects_base[j][4])
+        if start > 0:
+            print("Parced {} candidate pairs ({:.2f}%)".format(
+                num_pairs[start - 1], 100. * num_pairs[start - 1] / total))
 
-            # Continue to next iteration if distance is less than 0.5m apart or too far
-            if cam_dst < 0.5 or cam_dst > max_cam_dst: # NOTE maybe set this to 1m
-                object_dst[i, j] = -4 # Set an error value
-                object_dst[j, i] = -4
-                continue
+        batch = camera_object_pairs(cameras, cam_pairs[start:end])
+        metrics.count("candidate_pairs", len(batch))
 
-            # Get the distance to object and the RD-coordinates of the intersection
-            object_dst[i, j], object_dst[j, i], intersections[i, j, 0], intersections[i, j, 1] = \
-                                intersection_point(objects_base[i], objects_base[j])
+        # Get the distances to object and the RD-coordinates of the intersections
+        x, y, x_intersect, y_intersect = intersection_points(objects_base, batch[:, 0],
+                                                             batch[:, 1], rays)
 
-            # The other way around is the same
-            intersections[j, i, 0], intersections[j, i, 1] = \
-                                            intersections[i, j, 0], intersections[i, j, 1]
-
-            if object_dst[i, j] > 0:
-                num_intersections += 1
+        # Only keep the admissible intersections
+        admissible = (x > 0) | (y > 0)
+        num_intersections += np.count_nonzero(x > 0)
+        yield (batch[admissible], x[admissible], y[admissible],
+               np.column_stack((x_intersect, y_intersect))[admissible])
 
     print("All admissible intersections: {0:d}".format(num_intersections))
+    metrics.record("admissible_intersections", num_intersections)
 
-    return object_dst, intersections
+@metrics.stage("prune_intersections")
+def prune_intersections(graph, objects_base):
+    """
+    Remove the intersections of nearly parallel lines, below MIN_INTERSECTION_ANGLE,
+    which are numerically unstable and inflate the number of intersections of
+    every object in dense streets. Optionally only keep the MAX_OBJECT_INTERSECTIONS
+    closest intersections of every object. With EDGE_STORE_FOLDER the pruned graph
+    is built per chunk of objects in EDGE_STORE_FOLDER as well.
+    """
+    rays = ray_directions(objects_base)
+
+    if EDGE_STORE_FOLDER:
+        index_folder = os.path.join(EDGE_STORE_FOLDER, "index")
+        closest = None
+        if MAX_OBJECT_INTERSECTIONS is not None:
+            closest = closest_edges_on_disk(index_folder, graph, MAX_OBJECT_INTERSECTIONS,
+                                            EDGE_CHUNK_SIZE)
+
+        def select(sources, start, end):
+            keep = np.ones(end - start, dtype=bool)
+            if MIN_INTERSECTION_ANGLE:
+                keep &= wide_angle_edges(rays, sources, np.asarray(graph.indices[start:end]))
+            if closest is not None:
+                keep &= closest[start:end]
+            return keep
+
+        keep = edge_mask_on_disk(os.path.join(index_folder, "keep.bin"), graph, EDGE_CHUNK_SIZE,
+                                 select)
+    else:
+        keep = np.ones(len(graph.indices), dtype=bool)
+        if MIN_INTERSECTION_ANGLE:
+            keep &= wide_angle_edges(rays, edge_sources(graph), graph.indices)
+        if MAX_OBJECT_INTERSECTIONS is not None:
+            keep &= closest_edges(graph, MAX_OBJECT_INTERSECTIONS)
+
+    num_pruned = (len(keep) - np.count_nonzero(keep)) // 2
+    print("Pruned intersections: {0:d} of {1:d}".format(num_pruned, len(keep) // 2))
+    metrics.record("pruned_intersections", num_pruned)
+
+    if num_pruned == 0:
+        return graph
+    if EDGE_STORE_FOLDER:
+        return prune_graph_on_disk(os.path.join(EDGE_STORE_FOLDER, "pruned"), graph, keep,
+                                   EDGE_CHUNK_SIZE)
+    return prune_graph(graph, keep)
+
+def wide_angle_edges(rays, sources, targets):
+    """
+    Get whether the lines of the objects of every edge, with the directions
+    rays, intersect at an angle of at least MIN_INTERSECTION_ANGLE
+    """
+    ray_x, ray_y = rays
+    cross = ray_x[sources] * ray_y[targets] - ray_y[sources] * ray_x[targets]
+    norms = np.hypot(ray_x[sources], ray_y[sources]) * np.hypot(ray_x[targets], ray_y[targets])
+    return np.abs(cross) >= np.sin(np.radians(MIN_INTERSECTION_ANGLE)) * norms
 
-def mrf_energy_minimization(object_dst, objects_base):
+@metrics.stage("mrf_energy_minimization")
+def mrf_energy_minimization(graph, objects_base):
     """
     The designed MRF model operates on an irregular grid that consists of all of the
     intersections in the previous step. Energy minimization is achieved with Iterative
     Conditional Modes (ICM).
     """
+    seed = ICM_SEED
+    if seed is None:
+        seed = int(100000.0 * time.time()) % 1000000000
+
+    if ICM_WORKERS > 1:
+        objects_connectivity, accepted = parallel_icm(graph, objects_base, seed)
+    else:
+        index_folder = os.path.join(EDGE_STORE_FOLDER, "index") if EDGE_STORE_FOLDER else None
+        objects_connectivity, accepted = icm(graph, objects_base, seed, index_folder=index_folder)
+    metrics.record("accepted_flips_per_iteration", accepted)
+
+    return objects_connectivity
+
+def icm(graph, objects_base, seed, verbose=True, index_folder=None):
+    """
+    Iterative Conditional Modes on the connectivity of the graph edges, returns
+    the connectivity and the number of accepted changes of every iteration. The
+    per-edge indexes are stored as memory maps in index_folder if it is given.
+    """
 
-    objects_connectivity = np.zeros((len(objects_base),
-                                    len(objects_base)), dtype=np.uint8)
+    if ICM_SCHEDULE == "colored":
+        return colored_icm(graph, objects_base, seed, verbose, index_folder)
 
-    objects_connectivity_viable = np.zeros(len(objects_base),
-                                                dtype=np.uint8)
+    # The connectivity is stored per edge of the graph, in both directions
+    objects_connectivity = np.zeros(len(graph.indices), dtype=np.uint8)
 
-    for i in range(len(objects_base)):
-        objects_connectivity_viable[i] = \
-            np.count_nonzero(object_dst[i, :] > 0)
+    # The viable pairings of every object, so a random one is a single lookup
+    if index_folder:
+        viable_indptr, viable_pairings = viable_edges_on_disk(index_folder, graph,
+                                                              EDGE_CHUNK_SIZE)
+    else:
+        viable_indptr, viable_pairings = viable_edges(graph)
+    objects_connectivity_viable = np.diff(viable_indptr)
+
+    # Running state of every object, see state_energy
+    num_base = num_objects(objects_base)
+    objects_state = [(0, 0., 1000., 0.)] * num_base
+
+    np.random.seed(seed)
+    if ICM_SCHEDULE == "sweep":
+        accepted = icm_sweeps(graph, objects_base, objects_connectivity, objects_state,
+                              viable_indptr, viable_pairings, verbose)
+        return objects_connectivity, accepted
+    if ICM_SCHEDULE != "random":
+        raise ValueError("Unknown ICM schedule: {}".format(ICM_SCHEDULE))
 
-    np.random.seed(int(100000.0 * time.time()) % 1000000000)
     chngcnt = 0
-    for i in range(ICM_ITERATIONS * len(objects_base)):
-        if (i + 1) % len(objects_base) == 0:
-            print("Iteration #{}: accepted {} changes".format((i
-                                                               + 1) / len(objects_base), chngcnt))
+    accepted = []
+    for i in range(ICM_ITERATIONS * num_base):
+        if (i + 1) % num_base == 0:
+            accepted.append(chngcnt)
+            if verbose:
+                print("Iteration #{}: accepted {} changes".format((i
+                                                                   + 1) / num_base, chngcnt))
             chngcnt = 0
-        test_objectect = np.random.randint(0, len(objects_base))
+        test_objectect = np.random.randint(0, num_base)
         # no pairing possible (standalone - )
         if objects_connectivity_viable[test_objectect] == 0:
             continue
 
         randnum = 1 + np.random.randint(0, objects_connectivity_viable[test_objectect])
-        curcnt = 0
-        for j in range(len(objects_base)):
-            if object_dst[test_objectect, j] > 0:
-                curcnt += 1
-            if curcnt == randnum:
-                # Test the object pair
-                test_object_pair = j
-                break
-
-        energy_old = calc_energy(object_dst, objects_base,
-                                     objects_connectivity, test_objectect)
-
-        energy_old += calc_energy(object_dst, objects_base,
-                                      objects_connectivity, test_object_pair)
-
-        objects_connectivity[test_objectect, test_object_pair] = 1 \
-            - objects_connectivity[test_objectect, test_object_pair]
-        objects_connectivity[test_object_pair, test_objectect] = 1 \
-            - objects_connectivity[test_object_pair, test_objectect]
-
-        energy_new = calc_energy(object_dst, objects_base,
-                                     objects_connectivity, test_objectect)
-        energy_new += calc_energy(object_dst, objects_base,
-                                      objects_connectivity, test_object_pair)
-
-        if energy_new <= energy_old:
+
+        # Test the object pair
+        test_edge = viable_pairings[viable_indptr[test_objectect] + randnum - 1]
+        if icm_proposal(graph, objects_base, objects_connectivity, objects_state,
+                        test_objectect, test_edge):
             chngcnt += 1
-            continue
 
-        # revert to the old configuration
-        objects_connectivity[test_objectect, test_object_pair] = 1 \
-            - objects_connectivity[test_objectect, test_object_pair]
-        objects_connectivity[test_object_pair, test_objectect] = 1 \
-            - objects_connectivity[test_object_pair, test_objectect]
+    return objects_connectivity, accepted
 
-    return objects_connectivity
+def icm_proposal(graph, objects_base, objects_connectivity, objects_state, test_objectect,
+                 test_edge):
+    """
+    Toggle the connectivity of an edge if that does not increase the MRF energy
+    of its two objects, returns whether the change is accepted
+    """
+    test_object_pair = graph.indices[test_edge]
+    reverse_edge = graph.reverse[test_edge]
+
+    state_old = objects_state[test_objectect], objects_state[test_object_pair]
+    state_new = (toggle_state(graph, objects_base, objects_connectivity,
+                              state_old[0], test_objectect, test_edge),
+                 toggle_state(graph, objects_base, objects_connectivity,
+                              state_old[1], test_object_pair, reverse_edge))
+
+    energy_old = state_energy(state_old[0]) + state_energy(state_old[1])
+    energy_new = state_energy(state_new[0]) + state_energy(state_new[1])
+
+    if energy_new <= energy_old:
+        objects_connectivity[test_edge] = 1 - objects_connectivity[test_edge]
+        objects_connectivity[reverse_edge] = 1 - objects_connectivity[reverse_edge]
+        objects_state[test_objectect], objects_state[test_object_pair] = state_new
+        return True
+    return False
+
+def icm_sweeps(graph, objects_base, objects_connectivity, objects_state, viable_indptr,
+               viable_pairings, verbose=True):
+    """
+    ICM in sweeps over the objects that have viable pairings, in a random order
+    with a random pairing per object. Stops after ICM_ITERATIONS sweeps or once
+    a sweep accepts at most ICM_TOLERANCE of the viable objects. Returns the
+    number of accepted changes of every sweep.
+    """
+    viable = np.flatnonzero(np.diff(viable_indptr))
+    accepted = []
+    for sweep in range(ICM_ITERATIONS):
+        order = np.random.permutation(viable)
+        pairings = viable_indptr[order] + (np.random.rand(len(order))
+                                           * np.diff(viable_indptr)[order]).astype(np.int64)
+
+        chngcnt = 0
+        for test_objectect, test_edge in zip(order.tolist(), viable_pairings[pairings].tolist()):
+            if icm_proposal(graph, objects_base, objects_connectivity, objects_state,
+                            test_objectect, test_edge):
+                chngcnt += 1
+
+        accepted.append(chngcnt)
+        if verbose:
+            print("Sweep #{}: accepted {} changes".format(sweep + 1, chngcnt))
+        if chngcnt <= ICM_TOLERANCE * len(viable):
+            break
+
+    return accepted
+
+def colored_icm(graph, objects_base, seed, verbose=True, index_folder=None):
+    """
+    ICM in sweeps over all intersections, split into classes of which no two
+    intersections share an object (see matching_classes). The changes within
+    a class do not affect each other, so they are evaluated and applied for the
+    whole class at once with array operations. Every sweep visits the classes
+    in a random order and stops like icm_sweeps. With index_folder the classes
+    are memory maps, a class has at most half as many edges as there are
+    objects, so only the connectivity of the edges grows with the graph.
+    """
+    num_base = num_objects(objects_base)
+    objects_connectivity = np.zeros(len(graph.indices), dtype=np.uint8)
+
+    # Every intersection once, by its edge from the object with the lower index
+    if index_folder:
+        sources = edge_sources_on_disk(index_folder, graph, EDGE_CHUNK_SIZE)
+        edges = intersection_edges_on_disk(index_folder, graph, EDGE_CHUNK_SIZE)
+        classes = matching_classes_on_disk(index_folder, graph, edges, seed, EDGE_CHUNK_SIZE)
+        viable_indptr, _ = viable_edges_on_disk(index_folder, graph, EDGE_CHUNK_SIZE)
+    else:
+        sources = edge_sources(graph)
+        edges = intersection_edges(graph)
+        classes = matching_classes(graph, edges, seed)
+        viable_indptr, _ = viable_edges(graph)
+    num_viable = np.count_nonzero(np.diff(viable_indptr))
+    metrics.record("colors", len(classes))
+
+    # Running state of every object, see state_energy
+    link_count = np.zeros(num_base, dtype=np.int64)
+    depth_deviation = np.zeros(num_base)
+    dpthmin = np.full(num_base, 1000.)
+    dpthmax = np.zeros(num_base)
+    objects_state = (link_count, depth_deviation, dpthmin, dpthmax)
+
+    random_state = np.random.RandomState(seed % 2**32)
+    accepted = []
+    for sweep in range(ICM_ITERATIONS):
+        chngcnt = 0
+        for k in random_state.permutation(len(classes)):
+            test_edges = classes[k]
+            reverse_edges = graph.reverse[test_edges]
+            objects_1, objects_2 = sources[test_edges], graph.indices[test_edges]
+
+            state_old_1 = tuple(field[objects_1] for field in objects_state)
+            state_old_2 = tuple(field[objects_2] for field in objects_state)
+            state_new_1 = toggle_states(graph, objects_base, objects_connectivity,
+                                        state_old_1, objects_1, test_edges)
+            state_new_2 = toggle_states(graph, objects_base, objects_connectivity,
+                                        state_old_2, objects_2, reverse_edges)
+
+            energy_old = states_energy(*state_old_1) + states_energy(*state_old_2)
+            energy_new = states_energy(*state_new_1) + states_energy(*state_new_2)
+            accept = energy_new <= energy_old
+
+            objects_connectivity[test_edges[accept]] ^= 1
+            objects_connectivity[reverse_edges[accept]] ^= 1
+            for field, new_1, new_2 in zip(objects_state, state_new_1, state_new_2):
+                field[objects_1[accept]] = new_1[accept]
+                field[objects_2[accept]] = new_2[accept]
+            chngcnt += int(np.count_nonzero(accept))
+
+        accepted.append(chngcnt)
+        if verbose:
+            print("Sweep #{}: accepted {} changes".format(sweep + 1, chngcnt))
+        if chngcnt <= ICM_TOLERANCE * num_viable:
+            break
+
+    return objects_connectivity, accepted
+
+def component_icm(task):
+    """
+    Run ICM on the connected components of one task of parallel_icm, the
+    subgraphs of the components are in memory so their indexes are as well
+    """
+    return [icm(component_graph, component_objects, seed, verbose=False)
+            for component_graph, component_objects, seed in task]
 
-def clustering(objects_base, objects_connectivity, intersects):
+def parallel_icm(graph, objects_base, seed):
+    """
+    Run ICM on the independent connected components of the graph with a process
+    pool, each component with its own seed, and merge the results. The accepted
+    changes of every iteration are summed over the components.
+    """
+    import multiprocessing
+
+    num_components, labels = graph_components(graph)
+    component_seeds = np.random.RandomState(seed % 2**32).randint(0, 2**31 - 1,
+                                                                 num_components)
+
+    # Group the objects per component, only components with intersections are optimized
+    order = np.argsort(labels, kind="stable")
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    components = [component for component in np.split(order, bounds) if len(component) > 1]
+    print("Connected components with intersections: {0:d}".format(len(components)))
+    metrics.record("components", len(components))
+
+    # Bundle the small components into tasks to limit the scheduling overhead
+    tasks, task_edges, task, edges, task_size = [], [], [], [], 0
+    for component in components:
+        component_graph, component_edges = subgraph(graph, component)
+        task.append((component_graph, take_objects(objects_base, component),
+                     component_seeds[labels[component[0]]]))
+        edges.append(component_edges)
+        task_size += len(component)
+        if task_size >= ICM_TASK_SIZE:
+            tasks.append(task)
+            task_edges.append(edges)
+            task, edges, task_size = [], [], 0
+    if task:
+        tasks.append(task)
+        task_edges.append(edges)
+
+    objects_connectivity = np.zeros(len(graph.indices), dtype=np.uint8)
+    accepted = np.zeros(0, dtype=np.int64)
+    with multiprocessing.Pool(processes=ICM_WORKERS) as pool:
+        for edges, results in zip(task_edges, pool.imap(component_icm, tasks)):
+            for component_edges, (component_connectivity, component_accepted) in zip(edges,
+                                                                                     results):
+                objects_connectivity[component_edges] = component_connectivity
+                if len(component_accepted) > len(accepted):
+                    accepted = np.concatenate((accepted, np.zeros(
+                        len(component_accepted) - len(accepted), dtype=np.int64)))
+                accepted[:len(component_accepted)] += component_accepted
+
+    return objects_connectivity, accepted.tolist()
+
+@metrics.stage("clustering")
+def clustering(objects_base, objects_connectivity, graph):
     """
     To obtain the final object configuration we perform clustering of MRF output in
     order to merge groups of object instances that describe the same physical object.
     """
     d45 = 0.707 * MAX_CLUSTER_SIZE * 640 / 256 # TODO explain
-    ax, ay = objects_base[0][0] + d45, objects_base[0][1] + d45
-    max_intra_degree_dst = euclidean_distance(ax, ay, objects_base[0][0], objects_base[0][1])
+    ax, ay = objects_base.x_norm[0] + d45, objects_base.y_norm[0] + d45
+    max_intra_degree_dst = euclidean_distance(ax, ay, objects_base.x_norm[0], objects_base.y_norm[0])
 
     icm_intersect = []
-    for i in range(len(objects_base)):
-        res = avg_object_location(intersects, objects_connectivity, i)
+    for i in range(num_objects(objects_base)):
+        res = avg_object_location(graph, objects_connectivity, i)
         if res[0]:
             icm_intersect.append((res[0], res[1]))
 
     print("ICM inrersections: {0:d}".format(len(icm_intersect)))
+    metrics.record("icm_intersections", len(icm_intersect))
+    if not icm_intersect:
+        return np.zeros((0, 3))
 
     # Merge positive intersections that are likely to describe the same object.
     cluster_intersections = hierarchical_cluster(icm_intersect, max_intra_degree_dst)
+    metrics.record("clusters", len(cluster_intersections))
+
+    return cluster_intersections
+
+def geolocation(objects_base, input_key=None):
+    """
+    Estimate the object geolocations from the detected objects, the intersections
+    are cached when the key of the input file is given and they are kept in memory
+    """
+
+    # Step 2: Get the location of intersections
+    if input_key and not EDGE_STORE_FOLDER:
+        graph = cached_stage(CACHE_FOLDER, "intersections", input_key + "_" + str(MAX_DST_CAM_OBJECT),
+                             IntersectionGraph, get_all_intersections, objects_base)
+    else:
+        graph = get_all_intersections(objects_base)
+
+    if MIN_INTERSECTION_ANGLE or MAX_OBJECT_INTERSECTIONS is not None:
+        graph = prune_intersections(graph, objects_base)
+
+    # Step 3: MRF-based optimization approach
+    objects_connectivity = mrf_energy_minimization(graph, objects_base)
+
+    # Step 4: Cluster intersections
+    cluster_intersections = clustering(objects_base, objects_connectivity, graph)
+
+    return cluster_intersections
+
+@metrics.stage("voting")
+def voting(objects_base):
+    """
+    Estimate the object geolocations from the detected objects by ray voting
+    """
+    cluster_intersections = ray_voting(objects_base, MAX_DST_CAM_OBJECT, VOTING_CELL_SIZE,
+                                       VOTING_MIN_VIEWS)
+
+    print("Voting objects: {0:d}".format(len(cluster_intersections)))
+    metrics.record("clusters", len(cluster_intersections))
 
     return cluster_intersections
 
+def tiles_folder():
+    """
+    Get the folder of the finished tiles of the input file and the parameters
+    of all stages, so a rerun with other inputs or parameters starts over
+    """
+    parameters = (MAX_DST_CAM_OBJECT, MAX_CLUSTER_SIZE, MIN_INTERSECTION_ANGLE,
+                  MAX_OBJECT_INTERSECTIONS, ICM_ITERATIONS, ICM_SCHEDULE, ICM_TOLERANCE, ICM_SEED,
+                  DEPTH_WEIGHT, OBJECT_MULTIVIEW, STANDALONE_PRICE, TILE_SIZE, TILE_HALO)
+    return os.path.join(TILE_FOLDER, "{}_{}".format(
+        os.path.splitext(os.path.basename(INPUT_FILE))[0], cache_key(INPUT_FILE, *parameters)))
+
+def tiled_geolocation(objects_base):
+    """
+    Estimate the object geolocations per square tile of TILE_SIZE meters, to keep
+    the memory bounded for city-scale inputs. Every tile also uses the objects of
+    which the camera lies within TILE_HALO meters of the tile, and only keeps the
+    clusters that lie in the tile itself, so there is no double counting at the
+    tile seams. The clusters of every tile are saved, so an interrupted run
+    continues with the first unfinished tile of the same input and parameters.
+    """
+    halo = TILE_HALO
+    if halo < MAX_DST_CAM_OBJECT * 640 / 256:
+        print("Warning: the tile halo of {:.1f} m is shorter than the lines, clusters near the "
+              "tile seams can miss views".format(halo))
+    rings = max(int(np.ceil(halo / TILE_SIZE)), 1)
+    neighborhood = [(dx, dy) for dx in range(-rings, rings + 1) for dy in range(-rings, rings + 1)]
+    tile_folder = tiles_folder()
+    os.makedirs(tile_folder, exist_ok=True)
+
+    cam = np.column_stack((objects_base.x, objects_base.y))
+
+    # The tile of every camera location, shared by all objects of that camera
+    cameras = group_cameras(objects_base)
+    camera_tile = np.floor(np.column_stack((cameras.x, cameras.y)) / TILE_SIZE).astype(np.int64)
+    tile_index = np.empty((num_objects(objects_base), 2), dtype=np.int64)
+    tile_index[cameras.objects] = np.repeat(camera_tile, np.diff(cameras.indptr), axis=0)
+
+    # Group the objects per tile, a tile also needs the objects of its neighbors
+    tiles, tile_inverse = np.unique(tile_index, axis=0, return_inverse=True)
+    tile_inverse = tile_inverse.reshape(-1)
+    order = np.argsort(tile_inverse, kind="stable")
+    tile_objects = dict(zip(map(tuple, tiles),
+                            np.split(order, np.flatnonzero(np.diff(tile_inverse[order])) + 1)))
+    tiles_todo = sorted({(ix + dx, iy + dy) for ix, iy in tile_objects for dx, dy in neighborhood})
+
+    cluster_intersections = []
+    for k, (ix, iy) in enumerate(tiles_todo):
+        tile_file = os.path.join(tile_folder, "tile_{}_{}.npy".format(ix, iy))
+        if os.path.isfile(tile_file):
+            cluster_intersections.append(np.load(tile_file))
+            continue
+
+        print("Tile #{} of {}: ({}, {})".format(k + 1, len(tiles_todo), ix, iy))
+        x_min, y_min = ix * TILE_SIZE, iy * TILE_SIZE
+        x_max, y_max = x_min + TILE_SIZE, y_min + TILE_SIZE
+
+        candidates = [tile_objects[(ix + dx, iy + dy)] for dx, dy in neighborhood
+                      if (ix + dx, iy + dy) in tile_objects]
+        candidates = np.sort(np.concatenate(candidates))
+        in_halo = ((cam[candidates, 0] >= x_min - halo) & (cam[candidates, 0] < x_max + halo)
+                   & (cam[candidates, 1] >= y_min - halo) & (cam[candidates, 1] < y_max + halo))
+
+        with metrics.stage("tile"):
+            metrics.record("tile", [ix, iy])
+            metrics.record("objects", int(np.count_nonzero(in_halo)))
+            tile_clusters = np.zeros((0, 3))
+            if in_halo.any():
+                tile_clusters = geolocation(take_objects(objects_base, candidates[in_halo]))
+
+        # Only keep the clusters within the tile itself
+        tile_x = tile_clusters[:, 0] / tile_clusters[:, 2]
+        tile_y = tile_clusters[:, 1] / tile_clusters[:, 2]
+        tile_clusters = tile_clusters[(tile_x >= x_min) & (tile_x < x_max)
+                                      & (tile_y >= y_min) & (tile_y < y_max)]
+
+        # Write to a temporary file first, so only finished tiles are skipped
+        with open(tile_file + ".tmp", "wb") as f:
+            np.save(f, tile_clusters)
+        os.replace(tile_file + ".tmp", tile_file)
+        cluster_intersections.append(tile_clusters)
+
+    return np.concatenate(cluster_intersections)
+
+@metrics.stage("main")
 def main():
     start = time.time()
 
@@ -317,6 +819,10 @@ def main():
         print("Input file not found. Aborting.")
         return
 
+    if ENGINE not in ("mrf", "voting"):
+        print("Unknown engine: {}. Aborting.".format(ENGINE))
+        return
+
     try:
         f = open(OUTPUT_FILE, "w")
         f.close()
@@ -328,16 +834,21 @@ def main():
         print("A file with the specified ouput name already exists.")
 
     # Step 1: Read data from the input CSV file
-    objects_base = read_inputfile()
-
-    # Step 2: Get the location of intersections
-    object_dst, intersections = get_all_intersections(objects_base)
-
-    # Step 3: MRF-based optimization approach
-    objects_connectivity = mrf_energy_minimization(object_dst, objects_base)
+    input_key = None
+    if CACHE_FOLDER:
+        input_key = cache_key(INPUT_FILE)
+        objects_base = cached_stage(CACHE_FOLDER, "objects", input_key,
+                                    DetectedObjects, read_inputfile)
+    else:
+        objects_base = read_inputfile()
 
-    # Step 4: Cluster intersections
-    cluster_intersections = clustering(objects_base, objects_connectivity, intersections)
+    # Steps 2-4, at once or per tile, or the ray voting instead
+    if ENGINE == "voting":
+        cluster_intersections = voting(objects_base)
+    elif TILE_SIZE:
+        cluster_intersections = tiled_geolocation(objects_base)
+    else:
+        cluster_intersections = geolocation(objects_base, input_key)
 
     # Write to the output file
     num_clusters = cluster_intersections.shape[0]
@@ -350,6 +861,10 @@ def main():
 
     print("Number of output ICM clusters: {0:d}".format(num_clusters))
 
+    # The run is complete, its tiles are not needed to resume anymore
+    if ENGINE == "mrf" and TILE_SIZE:
+        shutil.rmtree(tiles_folder(), ignore_errors=True)
+
     print("Elapsed total time: {0:.2f} seconds.".format(time.time() - start))
 
 
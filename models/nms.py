@@ -0,0 +1,92 @@
+"""
+Non-maximum suppression of the bounding boxes of one panoramic image.
+The pairwise IoU matrix is computed in one vectorized pass, which is cheap for
+the typical number of boxes per image.
+
+Soft-NMS: Bodla et al., "Soft-NMS -- Improving Object Detection With One Line
+of Code", https://arxiv.org/abs/1704.04503
+"""
+import numpy as np
+
+
+def box_iou(boxes_1, boxes_2):
+    """
+    Calculate the intersection over union of all pairs of boxes (x0, y0, x1, y1)
+    """
+    boxes_1 = np.asarray(boxes_1, dtype=float).reshape(-1, 4)
+    boxes_2 = np.asarray(boxes_2, dtype=float).reshape(-1, 4)
+
+    area_1 = (boxes_1[:, 2] - boxes_1[:, 0]) * (boxes_1[:, 3] - boxes_1[:, 1])
+    area_2 = (boxes_2[:, 2] - boxes_2[:, 0]) * (boxes_2[:, 3] - boxes_2[:, 1])
+
+    # Width and height of the intersection of every pair
+    w = np.clip(np.minimum(boxes_1[:, None, 2], boxes_2[None, :, 2])
+                - np.maximum(boxes_1[:, None, 0], boxes_2[None, :, 0]), 0, None)
+    h = np.clip(np.minimum(boxes_1[:, None, 3], boxes_2[None, :, 3])
+                - np.maximum(boxes_1[:, None, 1], boxes_2[None, :, 1]), 0, None)
+    intersection = w * h
+
+    union = area_1[:, None] + area_2[None, :] - intersection
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, intersection / union, 0.)
+
+
+def nms(boxes, scores=None, iou_threshold=0.3):
+    """
+    Hard NMS: keep the best box and drop all boxes that overlap it by more than
+    iou_threshold, then repeat with the best remaining box. Without scores the
+    boxes are ranked on their bottom y-coordinate. Returns the indices of the
+    kept boxes, best first.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if scores is None:
+        scores = boxes[:, 3]
+
+    order = np.argsort(-np.asarray(scores, dtype=float), kind="stable")
+    overlaps = box_iou(boxes[order], boxes[order]) > iou_threshold
+
+    suppressed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= overlaps[i]
+
+    return order[keep]
+
+
+def soft_nms(boxes, scores, method="linear", iou_threshold=0.3, sigma=0.5,
+             score_threshold=0.001):
+    """
+    Soft-NMS: instead of dropping the boxes that overlap the best box, decay
+    their scores, linearly by (1 - IoU) for an IoU above iou_threshold or with a
+    Gaussian exp(-IoU^2 / sigma). Boxes with a score below score_threshold are
+    dropped. Returns the indices of the kept boxes, best first, and their scores.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    scores = np.array(scores, dtype=float)
+    if method not in ("linear", "gaussian"):
+        raise ValueError("Unknown Soft-NMS method: {}".format(method))
+
+    iou = box_iou(boxes, boxes)
+    remaining = np.flatnonzero(scores >= score_threshold)
+
+    keep = []
+    while len(remaining) > 0:
+        best = remaining[np.argmax(scores[remaining])]
+        keep.append(best)
+        remaining = remaining[remaining != best]
+
+        overlap = iou[best, remaining]
+        if method == "linear":
+            decay = np.where(overlap > iou_threshold, 1 - overlap, 1.)
+        else:
+            decay = np.exp(-overlap**2 / sigma)
+        scores[remaining] *= decay
+        remaining = remaining[scores[remaining] >= score_threshold]
+
+    keep = np.array(keep, dtype=np.int64)
+    return keep, scores[keep]
@@ -5,10 +5,15 @@ import matplotlib as mpl
 import numpy as np
 import cv2
 from PIL import Image
-import numpy as np
 import zipfile
-import pandas as pd
 import os
+import io
+import csv
+import glob
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
 
 # Setup detectron2 logger
 import detectron2
@@ -19,6 +24,18 @@ from detectron2.data import MetadataCatalog, DatasetCatalog
 from detectron2.config import get_cfg
 from detectron2.engine import DefaultPredictor
 
+from models.nms import nms, soft_nms
+
+ZIP_FILES = "datasets/panoramas/2019/row3/*.zip" # Zip files with the panoramic images
+OUTPUT_FILE = "bicycle_symbols.zip"
+DEVICE = "cpu" # Device of the model, e.g. "cpu" or "cuda"
+BATCH_SIZE = 4 # Number of images per model call
+DECODE_WORKERS = 4 # Number of threads reading and decoding images
+PREFETCH_IMAGES = 32 # Max number of decoded images waiting for the model
+NMS_METHOD = "linear" # Soft-NMS score decay "linear" or "gaussian", "hard" for NMS, None disables
+NMS_IOU_THRESH = 0.2 # IoU above which boxes suppress each other
+NMS_SCORE_THRESH = 0.5 # Min score of a box after the Soft-NMS score decay
+
 def draw_bbox(myfile, bboxes, filename):
     """
     Plot bbox in original image
@@ -47,77 +64,85 @@ def draw_bbox(myfile, bboxes, filename):
     fig.savefig(f"output_images/{filename}.png", dpi=200, bbox_inches='tight', pad_inches=0)
 
 
-def non_max_suppression(boxes, probs=None, overlap_thresh=0.3):
+def read_zip_images(zip_paths):
+    """
+    Iterate over the (zip_path, name) of the panoramic images in the zip files
+    """
+    for zip_path in zip_paths:
+        with zipfile.ZipFile(zip_path) as zip_file:
+            names = [name for name in zip_file.namelist() if name.endswith('.jpg')]
+        for name in names:
+            yield zip_path, name
+
+_local = threading.local()
+
+def decode_image(zip_path, name):
+    """
+    Read and decode one panoramic image, every thread keeps its own zip file handles
+    """
+    if not hasattr(_local, 'zip_files'):
+        _local.zip_files = {}
+    if zip_path not in _local.zip_files:
+        _local.zip_files[zip_path] = zipfile.ZipFile(zip_path)
+
+    filename = name.split("/")[-1].split(".jpg")[0]
+
+    # Open the images with the openCV reader because BGR order is used in Detectron2
+    pic = _local.zip_files[zip_path].read(name)
+    im = cv2.imdecode(np.frombuffer(pic, np.uint8), 1)
+
+    return filename, im
+
+def prefetch_images(zip_paths, num_workers=DECODE_WORKERS, prefetch=PREFETCH_IMAGES):
+    """
+    Decode the panoramic images with a thread pool, at most prefetch images
+    ahead of the consumer, and yield (filename, image) in order
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for zip_path, name in read_zip_images(zip_paths):
+            pending.append(executor.submit(decode_image, zip_path, name))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def batches(items, batch_size=BATCH_SIZE):
+    """
+    Group the items into lists of batch_size
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def predict_batch(predictor, images):
     """
-    This is a Python version used to implement the Soft NMS algorithm.
-    Original Paper：Soft-NMS--Improving Object Detection With One Line of Code
+    Run the model of a DefaultPredictor on a batch of BGR images at once, with
+    the same preprocessing as DefaultPredictor itself
     """
-    # If there are no boxes, return an empty list
-    if len(boxes) == 0:
-        return []
-
-    # If the bounding boxes are integers, convert them to floats -- this
-    # Is important since we'll be doing a bunch of divisions
-    if boxes.dtype.kind == "i":
-        boxes = boxes.astype("float")
-
-    # Initialize the list of picked indexes
-    pick = []
-
-    # grab the coordinates of the bounding boxes
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-
-    # Compute the area of the bounding boxes and grab the indexes to sort
-    # (in the case that no probabilities are provided, simply sort on the
-    # bottom-left y-coordinate)
-    area = (x2 - x1 + 1) * (y2 - y1 + 1)
-    idxs = y2
-
-    # If probabilities are provided, sort on them instead
-    if probs is not None:
-        idxs = probs
-
-    # Sort the indexes
-    idxs = np.argsort(idxs)
-
-    # Keep looping while some indexes still remain in the indexes list
-    while len(idxs) > 0:
-        # grab the last index in the indexes list and add the index value
-        # to the list of picked indexes
-        last = len(idxs) - 1
-        i = idxs[last]
-        pick.append(i)
-
-        # find the largest (x, y) coordinates for the start of the bounding
-        # box and the smallest (x, y) coordinates for the end of the bounding
-        # box
-        xx1 = np.maximum(x1[i], x1[idxs[:last]])
-        yy1 = np.maximum(y1[i], y1[idxs[:last]])
-        xx2 = np.minimum(x2[i], x2[idxs[:last]])
-        yy2 = np.minimum(y2[i], y2[idxs[:last]])
-
-        # compute the width and height of the bounding box
-        w = np.maximum(0, xx2 - xx1 + 1)
-        h = np.maximum(0, yy2 - yy1 + 1)
-
-        # compute the ratio of overlap
-        overlap = (w * h) / area[idxs[:last]]
-
-        # delete all indexes from the index list that have overlap greater
-        # than the provided overlap threshold
-        idxs = np.delete(idxs, np.concatenate(([last],
-            np.where(overlap > overlapThresh)[0])))
-
-    # return only the bounding boxes that were picked
-    return boxes[pick].astype("float")
+    inputs = []
+    for im in images:
+        if predictor.input_format == "RGB":
+            im = im[:, :, ::-1]
+        height, width = im.shape[:2]
+        image = predictor.aug.get_transform(im).apply_image(im)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        inputs.append({"image": image, "height": height, "width": width})
+
+    with torch.no_grad():
+        return predictor.model(inputs)
 
 def main():
     """
-    An example script on how to iterate over the images in a zip file 
-    and get predictions from Faster R-CNN. 
+    An example script on how to iterate over the images in zip files
+    and get predictions from Faster R-CNN. The images are decoded by a thread
+    pool while the model runs on batches of images, and the detections are
+    streamed to the output file.
     """
 
     cfg = get_cfg()
@@ -128,45 +153,49 @@ def main():
     cfg.MODEL.WEIGHTS = os.path.join(cfg.OUTPUT_DIR, "model.pth")
     cfg.MODEL.ROI_HEADS.NUM_CLASSES = 1 # Bicycle symbol
     cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.99
+    cfg.MODEL.DEVICE = DEVICE
 
     predictor = DefaultPredictor(cfg)
 
     # An example on how to use zipfile
-    zip_file = zipfile.ZipFile("datasets/panoramas/2019/row3/124300.0,487000.0,125500.0,483000.0.zip")
-
-    rows_list = []
-    for name in zip_file.namelist():
-        if name.endswith('.jpg'):
-            filename = name.split("/")[-1].split(".jpg")[0]
-
-            # Open the images with the openCV reader because BGR order is used in Detectron2
-            pic = zip_file.read(name)
-            im = cv2.imdecode(np.frombuffer(pic, np.uint8), 1)
-
-            all_instances = outputs['instances'].to('cpu')
-            boxes = all_instances.pred_boxes.tensor.numpy()
-            #scores = all_instances.scores.numpy()
-
-            # Use Soft-NMS
-            #bboxes_window = non_max_suppression(boxes, scores, 0.2)
-
-            for i in range(len(boxes)):
-                center_temp = (boxes[i][0] + boxes[i][2]) / 2
+    zip_paths = sorted(glob.glob(ZIP_FILES))
+
+    num_images = 0
+    with zipfile.ZipFile(OUTPUT_FILE, 'w', compression=zipfile.ZIP_DEFLATED) as output_zip, \
+            io.TextIOWrapper(output_zip.open('bicycle_symbols.csv', 'w'), newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(['pano_id', 'center_bbox'])
+
+        for batch in batches(prefetch_images(zip_paths)):
+            filenames, images = zip(*batch)
+            outputs = predict_batch(predictor, images)
+
+            for filename, output_image in zip(filenames, outputs):
+                all_instances = output_image['instances'].to('cpu')
+                boxes = all_instances.pred_boxes.tensor.numpy()
+                scores = all_instances.scores.numpy()
+
+                # Use Soft-NMS
+                if NMS_METHOD == "hard":
+                    boxes = boxes[nms(boxes, scores, NMS_IOU_THRESH)]
+                elif NMS_METHOD:
+                    keep, _ = soft_nms(boxes, scores, NMS_METHOD, NMS_IOU_THRESH,
+                                       score_threshold=NMS_SCORE_THRESH)
+                    boxes = boxes[keep]
 
                 # Save detection row by row
-                new_data = {'pano_id' : filename, 'center_bbox' : center_temp}
-                rows_list.append(new_data)
+                for i in range(len(boxes)):
+                    center_temp = (boxes[i][0] + boxes[i][2]) / 2
+                    writer.writerow([filename, center_temp])
 
-            # bboxes rounded to 1 decimal
-            #rounded_bboxes = [[np.round(float(i), 1) for i in nested] for nested in boxes]
+                # bboxes rounded to 1 decimal
+                #rounded_bboxes = [[np.round(float(i), 1) for i in nested] for nested in boxes]
 
-            # Draw predictions
-            #draw_bbox(myfile, rounded_bboxes, filename)
+                # Draw predictions
+                #draw_bbox(myfile, rounded_bboxes, filename)
 
-    # Save this file
-    df_output = pd.DataFrame(rows_list)
-    compression_opts = dict(method='zip', archive_name='bicycle_symbols.csv')
-    df_output.to_csv('bicycle_symbols.zip', index=False, compression=compression_opts)
+            num_images += len(batch)
+            print("Processed {} images".format(num_images))
 
 if __name__ == "__main__":
     main()
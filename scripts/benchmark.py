@@ -0,0 +1,254 @@
+"""
+Benchmark of the geolocation pipeline in main.py on synthetic inputs. Camera
+trajectories along straight streets and ground-truth objects next to them are
+generated at any scale, with noisy viewpoints and depths and false positive
+detections. Every pipeline stage is timed separately and the peak memory and
+the localization accuracy against the ground truth are recorded, so speedups
+can be shown not to degrade the results.
+"""
+import argparse
+import os
+import time
+import tracemalloc
+import numpy as np
+from scipy.spatial import cKDTree
+
+import main
+from src import metrics
+
+# Synthetic city
+STREET_LENGTH = 200  # Length of the straight street segments (in meters)
+CAMERA_SPACING = 5  # Distance between consecutive panoramic images (in meters)
+OBJECT_SPACING = 25  # Mean distance between objects along a street side (in meters)
+OBJECT_OFFSET = (2, 8)  # Range of the distance from the street center to an object (in meters)
+MAX_VIEW_DST = 12  # Max distance at which a camera detects an object (in meters)
+VIEW_PROBABILITY = 0.8  # Probability that a camera in range detects an object
+DETECTIONS_PER_STREET = 50  # Approximate number of detections per street, sets the city size
+
+# Accuracy
+MATCH_DST = 1  # Max distance between an output location and its ground-truth object (in meters)
+RESULTS_FILE = "benchmark_{}.csv"  # Results of all runs per engine, appended in the output folder
+
+
+def generate(num_detections, input_file, truth_file, noise=1., depth_noise=0.5,
+             false_positives=0.05, depth_fraction=0.5, seed=0):
+    """
+    Generate an input CSV file (x,y,viewpoint,depth) of num_detections detected
+    objects and a CSV file of the ground-truth objects (x,y,views). Streets are
+    added at random locations and directions in a square area scaled to the
+    number of detections, until there are enough detections. The viewpoints get
+    Gaussian noise of noise degrees, a depth_fraction of the detections get a
+    depth estimate with Gaussian noise of depth_noise meters and a fraction
+    false_positives of the detections point in a random direction.
+    """
+    rng = np.random.RandomState(seed)
+    area = STREET_LENGTH * np.sqrt(max(num_detections / DETECTIONS_PER_STREET, 1))
+    origin = np.array([120000., 485000.])  # Amsterdam in RD-coordinates
+
+    cameras, objects, views = [], [], []
+    num_objects, total = 0, 0
+    while total < num_detections:
+        start = origin + rng.uniform(0, area, 2)
+        angle = rng.uniform(0, 2 * np.pi)
+        direction = np.array([np.cos(angle), np.sin(angle)])
+        normal = np.array([-direction[1], direction[0]])
+
+        # Cameras along the street and objects on both sides of it
+        street_cameras = start + np.arange(0, STREET_LENGTH, CAMERA_SPACING)[:, None] * direction
+        count = rng.poisson(2 * STREET_LENGTH / OBJECT_SPACING)
+        street_objects = (start + rng.uniform(0, STREET_LENGTH, count)[:, None] * direction
+                          + (rng.choice([-1, 1], count) * rng.uniform(*OBJECT_OFFSET, count))[:, None]
+                          * normal)
+
+        # Every camera detects the objects in range with VIEW_PROBABILITY
+        dst = np.hypot(street_cameras[:, None, 0] - street_objects[None, :, 0],
+                       street_cameras[:, None, 1] - street_objects[None, :, 1])
+        camera, obj = np.nonzero((dst <= MAX_VIEW_DST)
+                                 & (rng.rand(*dst.shape) < VIEW_PROBABILITY))
+
+        cameras.append(street_cameras[camera])
+        objects.append(street_objects)
+        views.append(obj + num_objects)
+        num_objects += count
+        total += len(camera)
+
+    camera = np.concatenate(cameras)[:num_detections]
+    truth = np.concatenate(objects) if objects else np.zeros((0, 2))
+    view = np.concatenate(views)[:num_detections]
+
+    # Viewpoint from north clockwise, the pipeline looks in direction 180 + viewpoint
+    delta = truth[view] - camera
+    bearing = np.degrees(np.arctan2(delta[:, 0], delta[:, 1]))
+    viewpoint = bearing - 180 + rng.normal(0, noise, len(view))
+
+    # The depth is in the units of the normalized object locations (640 / 256 meters)
+    depth = (np.hypot(delta[:, 0], delta[:, 1]) + rng.normal(0, depth_noise, len(view))) * 256 / 640
+    depth = np.where((rng.rand(len(view)) < depth_fraction) & (depth > 0), depth, 0.)
+
+    # False positives point in a random direction and have no ground-truth object
+    false = rng.rand(len(view)) < false_positives
+    viewpoint[false] = rng.uniform(0, 360, np.count_nonzero(false))
+    depth[false] = 0.
+    view[false] = -1
+
+    np.savetxt(input_file, np.column_stack((camera, np.mod(viewpoint, 360), depth)),
+               delimiter=",", fmt=["%.3f", "%.3f", "%.2f", "%.2f"], comments="",
+               header="x,y,viewpoint,depth")
+
+    # Only the objects that are detected at least twice can be geolocated
+    num_views = np.bincount(view[view >= 0], minlength=len(truth))
+    visible = num_views >= 2
+    np.savetxt(truth_file, np.column_stack((truth[visible], num_views[visible])),
+               delimiter=",", fmt=["%.3f", "%.3f", "%d"], comments="", header="x,y,views")
+
+    print("Generated {} detections ({} false positives) of {} objects".format(
+        len(view), np.count_nonzero(false), np.count_nonzero(visible)))
+
+
+def run_stage(name, stage, trace_memory, *args):
+    """
+    Run a pipeline stage and measure its wall time, CPU time and memory. The
+    peak resident set size is that of the stage on Linux and that of the
+    whole process so far elsewhere (see src/metrics.py).
+    """
+    metrics.reset_peak_rss()
+    if trace_memory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+
+    result = stage(*args)
+
+    measurement = {
+        name + "_time": time.perf_counter() - wall,
+        name + "_cpu": time.process_time() - cpu,
+        name + "_rss": metrics.peak_rss(),
+        name + "_memory": float("nan")}
+    if trace_memory:
+        measurement[name + "_memory"] = tracemalloc.get_traced_memory()[1] / 2.**20
+        tracemalloc.stop()
+    return result, measurement
+
+
+def accuracy(locations, truth):
+    """
+    Compare the output locations with the ground-truth objects: the fraction of
+    output locations within MATCH_DST of an object (precision), the fraction of
+    objects within MATCH_DST of an output location (recall) and the mean distance
+    of the matched output locations to their nearest object
+    """
+    if len(locations) == 0 or len(truth) == 0:
+        return {"precision": 0., "recall": 0., "error": float("nan")}
+
+    dst, _ = cKDTree(truth).query(locations)
+    matched = dst <= MATCH_DST
+    found = cKDTree(locations).query(truth)[0] <= MATCH_DST
+
+    return {"precision": float(np.mean(matched)), "recall": float(np.mean(found)),
+            "error": float(np.mean(dst[matched])) if matched.any() else float("nan")}
+
+
+def benchmark(input_file, truth_file, trace_memory=False):
+    """
+    Run the stages of the geolocation pipeline on an input file and compare the
+    result with the ground truth
+    """
+    main.INPUT_FILE = input_file
+    results = {"input_file": input_file}
+
+    objects_base, measurement = run_stage("read", main.read_inputfile, trace_memory)
+    results.update(measurement)
+    results["detections"] = main.num_objects(objects_base)
+
+    if main.ENGINE == "voting":
+        cluster_intersections, measurement = run_stage("voting", main.voting, trace_memory,
+                                                       objects_base)
+        results.update(measurement)
+    else:
+        graph, measurement = run_stage("intersections", main.get_all_intersections,
+                                       trace_memory, objects_base)
+        results.update(measurement)
+        results["edges"] = len(graph.indices)
+
+        graph, measurement = run_stage("pruning", main.prune_intersections, trace_memory,
+                                       graph, objects_base)
+        results.update(measurement)
+        results["pruned_edges"] = results["edges"] - len(graph.indices)
+
+        objects_connectivity, measurement = run_stage("mrf", main.mrf_energy_minimization,
+                                                      trace_memory, graph, objects_base)
+        results.update(measurement)
+
+        cluster_intersections, measurement = run_stage("clustering", main.clustering,
+                                                       trace_memory, objects_base,
+                                                       objects_connectivity, graph)
+        results.update(measurement)
+
+    locations = cluster_intersections[:, :2] / cluster_intersections[:, 2:3]
+    truth = np.loadtxt(truth_file, delimiter=",", skiprows=1, ndmin=2)[:, :2]
+    results["clusters"] = len(locations)
+    results.update(accuracy(locations, truth))
+
+    return results
+
+
+def report(results, output_folder):
+    """
+    Print the results of a run and append them to the results file
+    """
+    for key, value in results.items():
+        print("{:>20}: {}".format(key, round(value, 4) if isinstance(value, float) else value))
+
+    results_file = os.path.join(output_folder, RESULTS_FILE.format(main.ENGINE))
+    new = not os.path.isfile(results_file)
+    with open(results_file, "a") as f:
+        if new:
+            f.write(",".join(results) + "\n")
+        f.write(",".join(str(value) for value in results.values()) + "\n")
+
+
+def main_benchmark(args):
+    os.makedirs(args.output_folder, exist_ok=True)
+    main.ENGINE = args.engine
+
+    for num_detections in args.num_detections:
+        name = "synthetic_{}_{}".format(num_detections, args.seed)
+        input_file = os.path.join(args.output_folder, name + ".csv")
+        truth_file = os.path.join(args.output_folder, name + "_truth.csv")
+
+        if not (os.path.isfile(input_file) and os.path.isfile(truth_file)):
+            generate(num_detections, input_file, truth_file, args.noise, args.depth_noise,
+                     args.false_positives, args.depth_fraction, args.seed)
+        if args.generate_only:
+            continue
+
+        results = benchmark(input_file, truth_file, args.trace_memory)
+        results.update(noise=args.noise, false_positives=args.false_positives, seed=args.seed)
+        report(results, args.output_folder)
+
+
+if __name__ == '__main__':
+    # Read command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_detections', type=int, nargs='+', default=[1000, 10000],
+                        help='Number(s) of detections of the synthetic inputs')
+    parser.add_argument('-o', '--output_folder', type=str, default='output/benchmark/',
+                        help='Folder for the synthetic inputs and the results')
+    parser.add_argument('--noise', type=float, default=1.,
+                        help='Standard deviation of the viewpoints (in degrees)')
+    parser.add_argument('--depth_noise', type=float, default=0.5,
+                        help='Standard deviation of the depth estimates (in meters)')
+    parser.add_argument('--depth_fraction', type=float, default=0.5,
+                        help='Fraction of the detections with a depth estimate')
+    parser.add_argument('--false_positives', type=float, default=0.05,
+                        help='Fraction of the detections that are false positives')
+    parser.add_argument('--engine', type=str, default=main.ENGINE, choices=['mrf', 'voting'],
+                        help='Localization engine to benchmark')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the synthetic inputs')
+    parser.add_argument('--trace_memory', action='store_true',
+                        help='Also trace the peak Python/NumPy memory of every stage (slower)')
+    parser.add_argument('--generate_only', action='store_true',
+                        help='Only generate the synthetic inputs')
+    args = parser.parse_args()
+
+    main_benchmark(args)
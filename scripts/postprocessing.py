@@ -1,44 +1,111 @@
 """
-Post-processing on the output data of Faster R-CNN to get 
+Post-processing on the output data of Faster R-CNN to get
 additional information from the Open Panorama API.
 """
-from src.api_request import get_pano_location
+from src import api_request
+from src.api_request import get_pano_locations
 from src.geometry import pixel_to_viewpoint
 
 import csv
+import json
 import numpy as np
 import glob
 import os
 
 PANO_WIDTH = 2000 # We used the "panorama_2000" images in Faster R-CNN
-NUM_WORKERS = 6
+NUM_WORKERS = 6 # Every worker also runs FETCH_WORKERS concurrent requests
+CHUNK_SIZE = 1000 # Number of unique panoramic images per work unit
+STREAMING = True # Append the output per block of rows and resume after a crash
+BLOCK_SIZE = 10000 # Number of input rows per streamed block (and checkpoint)
 INPUT_FOLDER = "data/faster_r-cnn_output/"
 OUTPUT_FOLDER = "data/postprocessing_output/"
 
-def process_csv(input_file):
+def read_csv(input_file):
     """
-    Iterate over the input CSV and get: 
-    - Camera location information
-    - Viewpoint of the camera to the detected object (in degrees)
+    Read the detections (pano_id, center_bbox) of the input CSV
+    and the number of broken entries
     """
-    rows_list = []
+    detections = []
+    broken = 0
     with open(input_file) as f:
         csv_reader = csv.reader(f, delimiter=",")
         next(f)  # skip the first line
         for row in csv_reader:
-            if len(row) < 2:
-                print("Broken entry ignored")
-                continue
-            if len(row) < 3:
-                pano_id, center_bbox = row[0], float(row[1])
-            else:
-                print("Broken entry ignored")
+            if len(row) != 2:
+                broken += 1
                 continue
+            try:
+                detections.append((row[0], float(row[1])))
+            except ValueError:
+                broken += 1
 
-            location = get_pano_location(pano_id)
-            viewpoint_to_object = pixel_to_viewpoint(center_bbox, PANO_WIDTH)
+    if broken:
+        print("Broken entries ignored in {}: {}".format(input_file, broken))
 
-            rows_list.append((location[0], location[1], round(viewpoint_to_object, 2)))
+    return detections
+
+def locate_chunk(pano_ids):
+    """
+    Get the locations of one work unit of panoramic images, any error is
+    returned instead of raised so it can be reported
+    """
+    try:
+        return get_pano_locations(pano_ids), None
+    except Exception as e:
+        return {}, "{}: {}".format(type(e).__name__, e)
+
+def init_worker(fetch_rate):
+    """
+    Set the request rate limit of a worker process to its share of FETCH_RATE
+    """
+    api_request.FETCH_RATE = fetch_rate
+
+def locate_panoramas(pano_ids):
+    """
+    Get the locations of the unique panoramic images, split into chunks of
+    CHUNK_SIZE that are processed across NUM_WORKERS processes, which share the
+    request rate limit of the API (FETCH_RATE in src/api_request.py). The
+    panoramic images that are not found give None, those of which the request
+    or the work unit failed are left out.
+    """
+    pano_ids = list(dict.fromkeys(pano_ids))
+    chunks = [pano_ids[i:i + CHUNK_SIZE] for i in range(0, len(pano_ids), CHUNK_SIZE)]
+
+    if NUM_WORKERS > 1 and len(chunks) > 1:
+        import multiprocessing
+
+        workers = min(NUM_WORKERS, len(chunks))
+        fetch_rate = api_request.FETCH_RATE / workers if api_request.FETCH_RATE else None
+        with multiprocessing.Pool(processes=workers, initializer=init_worker,
+                                  initargs=(fetch_rate,)) as p:
+            results = p.map(locate_chunk, chunks)
+    else:
+        results = [locate_chunk(chunk) for chunk in chunks]
+
+    locations = {}
+    for chunk, (chunk_locations, error) in zip(chunks, results):
+        if error:
+            print("Work unit of {} panoramic images failed: {}".format(len(chunk), error))
+        locations.update(chunk_locations)
+
+    return locations
+
+def write_csv(input_file, detections, locations):
+    """
+    Write the camera location information and viewpoint of the camera to the
+    detected object (in degrees), in the order of the input CSV
+    """
+    rows_list = []
+    skipped = 0
+    for pano_id, center_bbox in detections:
+        location = locations.get(pano_id)
+        if location is None:
+            skipped += 1
+            continue
+
+        viewpoint_to_object = pixel_to_viewpoint(center_bbox, PANO_WIDTH)
+
+        rows_list.append((location[0], location[1], round(viewpoint_to_object, 2)))
 
     output_file = OUTPUT_FOLDER + os.path.basename(input_file)
     if os.path.isfile(output_file):
@@ -48,23 +115,142 @@ def process_csv(input_file):
     np.savetxt(output_file, rows_list, delimiter=",", newline="\n", fmt="%s",
         comments="", header="x,y,viewpoint")
 
+    print("{}: {} rows written, {} rows skipped without location".format(
+        output_file, len(rows_list), skipped))
+
+def process_csv(input_file):
+    """
+    Iterate over the input CSV and get:
+    - Camera location information
+    - Viewpoint of the camera to the detected object (in degrees)
+    """
+    detections = read_csv(input_file)
+    locations = locate_panoramas(pano_id for pano_id, _ in detections)
+    write_csv(input_file, detections, locations)
+
+def input_fingerprint(input_file):
+    """
+    Get the size and modification time of the input file, which change when
+    the input file is replaced
+    """
+    status = os.stat(input_file)
+    return [status.st_size, status.st_mtime_ns]
+
+def read_checkpoint(checkpoint_file, fingerprint):
+    """
+    Read the number of finished input rows and the size of the output file
+    after those rows, or None if there is no checkpoint of this input file
+    """
+    if not os.path.isfile(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("input") != fingerprint:
+        print("The input file changed since the checkpoint, starting over.")
+        return None
+    return checkpoint["rows"], checkpoint["output_size"]
+
+def write_checkpoint(checkpoint_file, fingerprint, rows, output_size):
+    """
+    Write the checkpoint, replacing the previous one at once
+    """
+    with open(checkpoint_file + ".tmp", "w") as f:
+        json.dump({"input": fingerprint, "rows": rows, "output_size": output_size}, f)
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+def stream_csv(input_file):
+    """
+    Process the input CSV in blocks of BLOCK_SIZE rows and append the output
+    of every block as soon as it is resolved. After every block a checkpoint
+    records the finished input rows, so a run that crashed or stopped at an
+    API outage resumes with the first unfinished block, unless the input file
+    changed in the meantime. The checkpoint is removed once the last block is
+    written. The pano_ids that are not found are appended to a .failed file
+    next to the output.
+    """
+    fingerprint = input_fingerprint(input_file)
+    detections = read_csv(input_file)
+
+    output_file = OUTPUT_FOLDER + os.path.basename(input_file)
+    checkpoint_file = output_file + ".checkpoint"
+    failed_file = output_file + ".failed"
+
+    checkpoint = read_checkpoint(checkpoint_file, fingerprint)
+    if checkpoint is None or not os.path.isfile(output_file):
+        if os.path.isfile(output_file):
+            print("A file with the specified ouput name already exists.")
+        with open(output_file, "w") as f:
+            f.write("x,y,viewpoint\n")
+        if os.path.isfile(failed_file):
+            os.remove(failed_file)
+        rows_done = 0
+        write_checkpoint(checkpoint_file, fingerprint, rows_done, os.path.getsize(output_file))
+    else:
+        rows_done, output_size = checkpoint
+        # Remove any output written after the last checkpoint
+        with open(output_file, "r+") as f:
+            f.truncate(output_size)
+        print("Resuming {} at row {} of {}".format(input_file, rows_done, len(detections)))
+
+    written, skipped = 0, 0
+    for start in range(rows_done, len(detections), BLOCK_SIZE):
+        block = detections[start:start + BLOCK_SIZE]
+        locations = locate_panoramas(pano_id for pano_id, _ in block)
+
+        unresolved = [pano_id for pano_id, _ in block if pano_id not in locations]
+        if unresolved:
+            print("Panoramic images of rows {}-{} could not be requested, the API may be "
+                  "unavailable. Stopping, rerun to resume.".format(start, start + len(block)))
+            return
+        failed = [pano_id for pano_id, location in locations.items() if location is None]
+
+        rows_list = []
+        for pano_id, center_bbox in block:
+            location = locations[pano_id]
+            if location is None:
+                skipped += 1
+                continue
+
+            viewpoint_to_object = pixel_to_viewpoint(center_bbox, PANO_WIDTH)
+
+            rows_list.append((location[0], location[1], round(viewpoint_to_object, 2)))
+
+        with open(output_file, "a") as f:
+            f.writelines("{},{},{}\n".format(*row) for row in rows_list)
+            f.flush()
+            os.fsync(f.fileno())
+        if failed:
+            with open(failed_file, "a") as f:
+                f.writelines(pano_id + "\n" for pano_id in failed)
+        written += len(rows_list)
+
+        write_checkpoint(checkpoint_file, fingerprint, start + len(block),
+                         os.path.getsize(output_file))
+
+    # The output is complete, a rerun starts over
+    os.remove(checkpoint_file)
+    print("{}: {} rows written, {} rows skipped without location".format(
+        output_file, written, skipped))
+
 def main():
     input_files = glob.glob(INPUT_FOLDER + "*.csv")
     if len(input_files) < 1:
         print("No input file(s) found. Aborting.")
         return
 
-    if len(input_files) == 1:
-        process_csv(input_files[0])
-    else:
-        # Use multiprocessing if two or more input files are found
-        import multiprocessing
+    if STREAMING:
+        for input_file in input_files:
+            stream_csv(input_file)
+        return
 
-        p = multiprocessing.Pool(processes = NUM_WORKERS)
-        p.map_async(process_csv, input_files)
+    # The unique panoramic images of all input files are the work units,
+    # so a single large input file also uses all workers
+    detections = {input_file: read_csv(input_file) for input_file in input_files}
+    locations = locate_panoramas(pano_id for input_file in input_files
+                                 for pano_id, _ in detections[input_file])
 
-        p.close()
-        p.join()
+    for input_file in input_files:
+        write_csv(input_file, detections[input_file], locations)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,33 @@
+"""
+Convert the RD-coordinates (EPSG:28992) of the estimated object locations to
+WGS84 latitudes and longitudes (EPSG:4326), e.g. to create
+output/bicycle_symbol_locations_2019_latlng.csv from the RD version.
+"""
+import argparse
+import numpy as np
+
+from src.coordinates import rd_to_wgs84
+
+def main(input_file, output_file):
+    locations = np.loadtxt(input_file, delimiter=",", skiprows=1, ndmin=2)
+
+    # Convert all locations at once
+    lons, lats = rd_to_wgs84(locations[:, 0], locations[:, 1])
+
+    with open(output_file, "w") as f:
+        f.write("lat,lon\n")
+        for lat, lon in zip(lats.tolist(), lons.tolist()):
+            f.write("{},{}\n".format(round(lat, 6), round(lon, 6)))
+
+    print("Converted {0:d} locations".format(len(locations)))
+
+if __name__ == '__main__':
+    # Read command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_file', type=str, required=True,
+                        help='Input csv file with RD-coordinates (x,y,...)')
+    parser.add_argument('-o', '--output_file', type=str, required=True,
+                        help='Output csv file with latitudes and longitudes')
+    args = parser.parse_args()
+
+    main(args.input_file, args.output_file)
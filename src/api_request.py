@@ -1,58 +1,206 @@
-import requests
 import json
-from osgeo import ogr, osr
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.coordinates import wgs84_to_rd
+from src.pano_cache import MISSING, PanoCache
+
+PANO_API_URL = "https://api.data.amsterdam.nl/panorama/panoramas/{}/"
+
+# Cache of the panorama metadata, shared by all API calls, which also remembers
+# the panoramic images that are not found. Set the TTL (in seconds) to refresh
+# old entries, with None they are kept forever.
+PANO_CACHE = PanoCache("cache/panoramas.sqlite", ttl=None)
+
+# Batch requests to the API
+FETCH_WORKERS = 8  # Number of concurrent requests (and pooled connections)
+FETCH_RATE = 20  # Max number of requests per second (None disables)
+FETCH_RETRIES = 3  # Number of retries of failed requests
+FETCH_BACKOFF = 0.5  # Waiting time before the first retry, doubled every retry (in seconds)
+FETCH_TIMEOUT = 30  # Timeout of a request (in seconds)
+
+_session = None
+_session_pid = None
+_rate_lock = threading.Lock()
+_next_request = 0.
+
+def get_session():
+    """
+    Get the HTTP session of this process, which reuses its connections
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_WORKERS)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+        _session_pid = os.getpid()
+    return _session
+
+def _wait_for_rate_limit():
+    """
+    Wait until the next request is allowed by FETCH_RATE
+    """
+    global _next_request
+    if not FETCH_RATE:
+        return
+    with _rate_lock:
+        now = time.time()
+        wait = _next_request - now
+        _next_request = max(now, _next_request) + 1. / FETCH_RATE
+    if wait > 0:
+        time.sleep(wait)
+
+class ApiUnavailableError(Exception):
+    """
+    The API kept failing (connection errors, 408, 429 or 5xx) after all retries
+    """
+
+class ApiResponseError(ApiUnavailableError):
+    """
+    The API gave an unexpected response, another 4xx status than 404 or a body
+    without the metadata, which is not retried and not cached
+    """
+
+def fetch_pano_metadata(pano_id):
+    """
+    Request the metadata of a panoramic image that is used in this project from
+    the API: the geometry, the heading and the image links, or None if it is not
+    found (404). Connection errors, timeouts (408), rate limiting (429) and server
+    errors (5xx) are retried with exponential backoff, other unexpected responses
+    raise an ApiResponseError.
+    """
+    for attempt in range(FETCH_RETRIES + 1):
+        if attempt:
+            time.sleep(FETCH_BACKOFF * 2**(attempt - 1))
+        _wait_for_rate_limit()
+        try:
+            response = get_session().get(PANO_API_URL.format(pano_id), timeout=FETCH_TIMEOUT)
+        except requests.exceptions.RequestException:
+            continue
+        if response.status_code in (408, 429) or response.status_code >= 500:
+            continue
+        if response.status_code == 404:
+            return
+        if response.status_code >= 400:
+            raise ApiResponseError("Status {} for {}".format(response.status_code, pano_id))
+
+        try:
+            pano_data = json.loads(response.content)
+            return {
+                'geometry': pano_data['geometry'],
+                'heading': pano_data['heading'],
+                '_links': pano_data['_links']
+            }
+        except (ValueError, KeyError, TypeError):
+            raise ApiResponseError("No metadata in the response for {}".format(pano_id))
+
+    raise ApiUnavailableError("No response for {} after {} retries".format(pano_id, FETCH_RETRIES))
+
+def get_pano_metadata(pano_id):
+    """
+    Get the metadata of a panoramic image, requested from the API once and then
+    served from PANO_CACHE, or None if it is not found
+    """
+    metadata = PANO_CACHE.get(pano_id, MISSING)
+    if metadata is MISSING:
+        try:
+            metadata = fetch_pano_metadata(pano_id)
+        except ApiUnavailableError:
+            print('HTTP Request failed. Aborting.')
+            return
+        PANO_CACHE.put(pano_id, metadata)
+
+    if metadata is None:
+        print('HTTP Request failed. Aborting.')
+    return metadata
+
+def get_pano_metadatas(pano_ids):
+    """
+    Get the metadata of many panoramic images, keyed by pano_id. Duplicate
+    pano_ids are requested once and the panoramic images that are not cached
+    yet are requested concurrently. Panoramic images that are not found give
+    None and are cached as such, those that could not be requested because the
+    API kept failing or gave an unexpected response are left out.
+    """
+    results = {}
+    missing = []
+    for pano_id in dict.fromkeys(pano_ids):
+        results[pano_id] = PANO_CACHE.get(pano_id, MISSING)
+        if results[pano_id] is MISSING:
+            missing.append(pano_id)
+
+    unavailable = 0
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = [executor.submit(fetch_pano_metadata, pano_id) for pano_id in missing]
+        for pano_id, future in zip(missing, futures):
+            try:
+                results[pano_id] = future.result()
+            except ApiUnavailableError:
+                del results[pano_id]
+                unavailable += 1
+                continue
+            PANO_CACHE.put(pano_id, results[pano_id])
+
+    not_found = sum(metadata is None for metadata in results.values())
+    if not_found or unavailable:
+        print("HTTP Request failed for {} of {} panoramic images ({} not found).".format(
+            not_found + unavailable, len(results) + unavailable, not_found))
+
+    return results
 
 def get_pano_location(pano_id):
     """
-    Get the initial location coordinates of a panoramic image 
+    Get the initial location coordinates of a panoramic image
     and convert it from WGS84 (EPSG:4326) to Rijksdriehoek (EPSG:28992)
-    
+
     Amsterdam API description: https://api.data.amsterdam.nl/api/
     """
-    pano_url = f"https://api.data.amsterdam.nl/panorama/panoramas/{pano_id}/"
-    
-    try:
-        response = requests.get(pano_url)
-        pano_data = json.loads(response.content)
-    except requests.exceptions.RequestException:
-        print('HTTP Request failed. Aborting.')
+    pano_data = get_pano_metadata(pano_id)
+    if pano_data is None:
         return
-    
+
     # Get location coordinates
     geom = pano_data['geometry']['coordinates']
-    
-    # WGS84 to RD conversion 
-    point = ogr.Geometry(ogr.wkbPoint)
-    point.AddPoint(geom[0], geom[1])
-    
-    source = osr.SpatialReference()
-    source.ImportFromEPSG(4326)
-    
-    target = osr.SpatialReference()
-    target.ImportFromEPSG(28992)
-    
-    transform = osr.CoordinateTransformation(source, target)
-    point.Transform(transform)
-
-    return [point.GetX(), point.GetY()]
+
+    # WGS84 to RD conversion
+    x, y = wgs84_to_rd(geom[0], geom[1])
+
+    return [float(x), float(y)]
+
+def get_pano_locations(pano_ids):
+    """
+    Get the RD-coordinates of many panoramic images at once, keyed by pano_id,
+    with the same None and left out entries as get_pano_metadatas
+    """
+    pano_data = get_pano_metadatas(pano_ids)
+    found = [pano_id for pano_id, metadata in pano_data.items() if metadata is not None]
+    geoms = [pano_data[pano_id]['geometry']['coordinates'] for pano_id in found]
+
+    # WGS84 to RD conversion of all locations at once
+    xs, ys = wgs84_to_rd([geom[0] for geom in geoms], [geom[1] for geom in geoms])
+
+    locations = dict.fromkeys(pano_data)
+    locations.update((pano_id, [x, y]) for pano_id, x, y in zip(found, xs.tolist(), ys.tolist()))
+    return locations
 
 def get_pano_data(pano_id):
     """
     Get panoramic image url and orientation information using the API
     """
-    pano_url = f"https://api.data.amsterdam.nl/panorama/panoramas/{pano_id}/" 
-    
-    try:
-        response = requests.get(pano_url)
-        pano_data = json.loads(response.content)
-    except requests.exceptions.RequestException:
-        print('HTTP Request failed. Aborting.')
+    pano_data = get_pano_metadata(pano_id)
+    if pano_data is None:
         return
-    
+
     # Get panoramic image from API
     image_url = pano_data['_links']['equirectangular_small']['href']
-    
+
     # Get heading
     heading = pano_data['heading']
 
-    return image_url, heading
\ No newline at end of file
+    return image_url, heading
@@ -0,0 +1,65 @@
+"""
+Conversion between WGS84 (EPSG:4326) and Rijksdriehoek (EPSG:28992)
+coordinates. The coordinate transformations are built once and reused, and
+whole arrays of coordinates are converted in a single call.
+"""
+import numpy as np
+from osgeo import osr
+
+WGS84 = 4326
+RD = 28992
+
+_transforms = {}
+
+
+def _spatial_reference(epsg):
+    """
+    Get the spatial reference of an EPSG code, with the longitude or x first
+    """
+    reference = osr.SpatialReference()
+    reference.ImportFromEPSG(epsg)
+    # GDAL 3 follows the axis order of the EPSG definition (latitude first for
+    # EPSG:4326), keep the traditional order that GDAL 2 uses
+    if hasattr(reference, "SetAxisMappingStrategy"):
+        reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return reference
+
+
+def get_transform(source_epsg, target_epsg):
+    """
+    Get the coordinate transformation between two EPSG codes, built on first use
+    """
+    key = (source_epsg, target_epsg)
+    if key not in _transforms:
+        _transforms[key] = osr.CoordinateTransformation(_spatial_reference(source_epsg),
+                                                        _spatial_reference(target_epsg))
+    return _transforms[key]
+
+
+def transform_points(xs, ys, source_epsg, target_epsg):
+    """
+    Transform arrays (or scalars) of coordinates between two EPSG codes
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    if xs.size == 0:
+        return xs.copy(), ys.copy()
+
+    points = np.column_stack((xs.ravel(), ys.ravel()))
+    result = np.array(get_transform(source_epsg, target_epsg).TransformPoints(points.tolist()))
+
+    return result[:, 0].reshape(xs.shape), result[:, 1].reshape(xs.shape)
+
+
+def wgs84_to_rd(lons, lats):
+    """
+    Convert WGS84 longitudes and latitudes to RD-coordinates (x, y)
+    """
+    return transform_points(lons, lats, WGS84, RD)
+
+
+def rd_to_wgs84(xs, ys):
+    """
+    Convert RD-coordinates to WGS84 longitudes and latitudes
+    """
+    return transform_points(xs, ys, RD, WGS84)
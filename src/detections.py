@@ -0,0 +1,141 @@
+"""
+Columnar storage of the detected objects, with one NumPy array per field
+instead of one tuple per object, and a fast loader for the input CSV file.
+"""
+from collections import namedtuple
+import numpy as np
+
+DEFAULT_DEPTH = 5  # Depth estimate used when it is omitted or not positive (in meters)
+
+# One array per field, with one value per detected object: the normalized object
+# location (at 1m distance from camera), the viewpoint from north clockwise in
+# degrees (not used), the depth estimate, the camera location and the depth-based
+# object location (not used, only normalized locations are used in the pipeline)
+DetectedObjects = namedtuple("DetectedObjects", ["x_norm", "y_norm", "viewpoint", "depth",
+                                                 "x", "y", "x_object", "y_object"])
+
+
+def detected_objects(x, y, viewpoint_to_object, depth=None):
+    """
+    Calculate the object locations of arrays of detected objects using
+    camera location + viewpoint_to_object + depth_estimate
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    viewpoint_to_object = np.asarray(viewpoint_to_object, dtype=float)
+    if depth is None:
+        depth = np.full(len(x), DEFAULT_DEPTH, dtype=float)
+    depth = np.asarray(depth, dtype=float)
+    depth = np.where(depth > 0, depth, DEFAULT_DEPTH)
+
+    br1 = np.radians(180 + viewpoint_to_object)
+    sin_br1, cos_br1 = np.sin(br1), np.cos(br1)
+
+    return DetectedObjects(
+        x + (1.0 * sin_br1 * 640 / 256),  # normalized locations (at 1m distance from camera)
+        y + (1.0 * cos_br1 * 640 / 256),
+        viewpoint_to_object,
+        depth,
+        x,
+        y,
+        x + (depth * sin_br1 * 640 / 256),  # depth-based locations
+        y + (depth * cos_br1 * 640 / 256))
+
+
+def take_objects(objects, index):
+    """
+    Get the detected objects at an index array or boolean mask
+    """
+    return DetectedObjects._make(field[index] for field in objects)
+
+
+def num_objects(objects):
+    """
+    Get the number of detected objects
+    """
+    return len(objects.x)
+
+
+def read_detections(input_file):
+    """
+    Read the input CSV file in bulk into column arrays of the camera location
+    (x, y), the viewpoint and the depth estimate. A missing depth estimate is
+    returned as zero. Also returns the line numbers of the malformed rows.
+    """
+    with open(input_file, "r") as f:
+        next(f)  # skip the first line
+        lines = f.read().splitlines()
+
+    num_fields = np.array([line.count(",") + 1 for line in lines], dtype=np.int64)
+    values = np.zeros((len(lines), 4))
+    parsed = np.zeros(len(lines), dtype=bool)
+
+    # Rows with three or four fields are converted per group in a single call,
+    # the other rows and the groups with unparsable values are parsed per row
+    for fields in (3, 4):
+        rows = np.flatnonzero(num_fields == fields)
+        if len(rows) == 0:
+            continue
+        try:
+            group = np.array(",".join([lines[i] for i in rows]).split(","), dtype=float)
+        except ValueError:
+            continue
+        values[rows, :fields] = group.reshape(-1, fields)
+        parsed[rows] = True
+
+    malformed = []
+    for i in np.flatnonzero(~parsed):
+        nums = lines[i].split(",")
+        try:
+            if len(nums) < 3:
+                raise ValueError
+            values[i, :3] = [float(num) for num in nums[:3]]
+            if len(nums) > 3 and nums[3].strip():
+                values[i, 3] = float(nums[3])
+            parsed[i] = True
+        except ValueError:
+            malformed.append(int(i) + 2)  # line number in the file, after the header
+
+    values = values[parsed]
+
+    return values[:, 0], values[:, 1], values[:, 2], values[:, 3], malformed
+
+
+# The detected objects grouped per camera location, i.e. per panoramic image:
+# the location of every camera and, in CSR form, the indices of the detected
+# objects of camera k at objects[indptr[k]:indptr[k + 1]]
+Cameras = namedtuple("Cameras", ["x", "y", "indptr", "objects"])
+
+
+def group_cameras(objects):
+    """
+    Group the detected objects by their camera location
+    """
+    locations, camera = np.unique(np.column_stack((objects.x, objects.y)), axis=0,
+                                  return_inverse=True)
+    camera = camera.reshape(-1)
+
+    indptr = np.zeros(len(locations) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(camera, minlength=len(locations)), out=indptr[1:])
+
+    return Cameras(locations[:, 0], locations[:, 1], indptr,
+                   np.argsort(camera, kind="stable"))
+
+
+def camera_object_pairs(cameras, camera_pairs):
+    """
+    Get all pairs (i < j) of detected objects of pairs of different cameras
+    """
+    camera_pairs = np.asarray(camera_pairs, dtype=np.int64).reshape(-1, 2)
+    counts = np.diff(cameras.indptr)
+    count_1, count_2 = counts[camera_pairs[:, 0]], counts[camera_pairs[:, 1]]
+    num_pairs = count_1 * count_2
+
+    # Position of every object pair within the pairs of its camera pair
+    pair = np.repeat(np.arange(len(camera_pairs)), num_pairs)
+    offset = np.arange(num_pairs.sum()) - np.repeat(np.cumsum(num_pairs) - num_pairs, num_pairs)
+
+    object_1 = cameras.objects[cameras.indptr[camera_pairs[pair, 0]] + offset // count_2[pair]]
+    object_2 = cameras.objects[cameras.indptr[camera_pairs[pair, 1]] + offset % count_2[pair]]
+
+    return np.column_stack((np.minimum(object_1, object_2), np.maximum(object_1, object_2)))
@@ -0,0 +1,365 @@
+"""
+Out-of-core build of the sparse graph of intersections (see src/graph.py) for
+inputs of which the edges do not fit in memory. The edges are streamed to disk
+batch by batch and sorted into .npy files in chunks, which are then used as
+memory maps, so the memory stays bounded by the chunk size. The pruned graph
+and the per-edge indexes used by the MRF are built in the same way.
+"""
+import os
+import shutil
+import numpy as np
+
+from src.graph import IntersectionGraph, matching_priorities
+
+# Temporary files of the unsorted edges, with their data type and columns
+_UNSORTED = {"sources": (np.int64, 1), "targets": (np.int64, 1),
+             "dst": (np.float64, 1), "points": (np.float64, 2)}
+
+
+def build_graph_on_disk(folder, num_objects, batches, chunk_size=10000000):
+    """
+    Build the sparse graph from batches of (pairs, dst_1, dst_2, points) like
+    build_graph, with the arrays stored in folder and returned as memory maps.
+    Every pass over the edges handles at most chunk_size edges at once.
+    """
+    tmp_folder = folder + ".tmp"
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    # Pass 1: append both directed edges of every pair to the unsorted files
+    # and count the edges of every object
+    counts = np.zeros(num_objects, dtype=np.int64)
+    files = {name: open(os.path.join(tmp_folder, name + ".bin"), "wb") for name in _UNSORTED}
+    try:
+        for pairs, dst_1, dst_2, points in batches:
+            pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+            points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+            columns = {"sources": (pairs[:, 0], pairs[:, 1]), "targets": (pairs[:, 1], pairs[:, 0]),
+                       "dst": (dst_1, dst_2), "points": (points, points)}
+            for name, (dtype, _) in _UNSORTED.items():
+                for column in columns[name]:
+                    files[name].write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+            counts += np.bincount(pairs.reshape(-1), minlength=num_objects)
+    finally:
+        for f in files.values():
+            f.close()
+
+    num_edges = int(counts.sum())
+    unsorted = {name: _read_unsorted(os.path.join(tmp_folder, name + ".bin"), dtype, width,
+                                     num_edges)
+                for name, (dtype, width) in _UNSORTED.items()}
+
+    indptr = np.zeros(num_objects + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    np.save(os.path.join(tmp_folder, "indptr.npy"), indptr)
+
+    indices = _create(tmp_folder, "indices", np.int64, (num_edges,))
+    dst = _create(tmp_folder, "dst", np.float64, (num_edges,))
+    points = _create(tmp_folder, "points", np.float64, (num_edges, 2))
+    keys = _create(tmp_folder, "keys", np.int64, (num_edges,))
+
+    # Pass 2: place every edge in the rows of its source object (counting sort)
+    cursor = indptr[:-1].copy()
+    for start in range(0, num_edges, chunk_size):
+        sources = np.asarray(unsorted["sources"][start:start + chunk_size])
+        order = np.argsort(sources, kind="stable")
+        sorted_sources = sources[order]
+
+        # Rank of every edge among the edges of the same object in this chunk
+        first = np.searchsorted(sorted_sources, sorted_sources, side="left")
+        positions = cursor[sorted_sources] + np.arange(len(order)) - first
+        cursor += np.bincount(sources, minlength=num_objects)
+
+        indices[positions] = unsorted["targets"][start:start + chunk_size][order]
+        dst[positions] = unsorted["dst"][start:start + chunk_size][order]
+        points[positions] = unsorted["points"][start:start + chunk_size][order]
+
+    # Pass 3: sort the edges of every object by the other object, per chunk of objects
+    for first_object, last_object in _object_chunks(indptr, chunk_size):
+        start, end = indptr[first_object], indptr[last_object]
+        sources = np.repeat(np.arange(first_object, last_object),
+                            np.diff(indptr[first_object:last_object + 1]))
+        targets = np.array(indices[start:end])
+        order = np.lexsort((targets, sources))
+        targets = targets[order]
+
+        indices[start:end] = targets
+        dst[start:end] = dst[start:end][order]
+        points[start:end] = points[start:end][order]
+        keys[start:end] = sources * num_objects + targets
+
+    # Pass 4: the opposite edge of (i, j) is the edge with the key j * N + i
+    reverse = _create(tmp_folder, "reverse", np.int64, (num_edges,))
+    for first_object, last_object in _object_chunks(indptr, chunk_size):
+        start, end = indptr[first_object], indptr[last_object]
+        sources = np.repeat(np.arange(first_object, last_object),
+                            np.diff(indptr[first_object:last_object + 1]))
+        reverse[start:end] = np.searchsorted(keys, indices[start:end] * num_objects + sources)
+
+    for array in (indices, dst, points, reverse):
+        array.flush()
+    del unsorted, indices, dst, points, keys, reverse
+    for name in _UNSORTED:
+        os.remove(os.path.join(tmp_folder, name + ".bin"))
+    os.remove(os.path.join(tmp_folder, "keys.npy"))
+
+    return _replace_graph(tmp_folder, folder)
+
+
+def load_graph(folder):
+    """
+    Load a graph stored by build_graph_on_disk as memory maps
+    """
+    return IntersectionGraph._make(np.load(os.path.join(folder, field + ".npy"), mmap_mode="r")
+                                   for field in IntersectionGraph._fields)
+
+
+def prune_graph_on_disk(folder, graph, keep, chunk_size=10000000):
+    """
+    Get the graph without the edges of which keep is False like prune_graph,
+    with the arrays stored in folder and returned as memory maps. Every pass
+    over the edges handles the edges of a chunk of objects at once.
+    """
+    tmp_folder = folder + ".tmp"
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    num_objects = len(graph.indptr) - 1
+
+    # Pass 1: count the kept edges of every object and get their new positions
+    counts = np.zeros(num_objects, dtype=np.int64)
+    position = _create(tmp_folder, "position", np.int64, (len(graph.indices),))
+    num_kept = 0
+    for first_object, last_object in _object_chunks(graph.indptr, chunk_size):
+        start, end = graph.indptr[first_object], graph.indptr[last_object]
+        kept = np.asarray(keep[start:end])
+        sources = np.repeat(np.arange(last_object - first_object),
+                            np.diff(graph.indptr[first_object:last_object + 1]))
+        counts[first_object:last_object] = np.bincount(sources[kept],
+                                                       minlength=last_object - first_object)
+        position[start:end] = num_kept + np.cumsum(kept, dtype=np.int64) - 1
+        num_kept += int(np.count_nonzero(kept))
+
+    indptr = np.zeros(num_objects + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    np.save(os.path.join(tmp_folder, "indptr.npy"), indptr)
+
+    # Pass 2: copy the kept edges, the opposite edge moves to its new position
+    indices = _create(tmp_folder, "indices", np.int64, (num_kept,))
+    dst = _create(tmp_folder, "dst", np.float64, (num_kept,))
+    points = _create(tmp_folder, "points", np.float64, (num_kept, 2))
+    reverse = _create(tmp_folder, "reverse", np.int64, (num_kept,))
+    for first_object, last_object in _object_chunks(graph.indptr, chunk_size):
+        start, end = graph.indptr[first_object], graph.indptr[last_object]
+        edges = start + np.flatnonzero(keep[start:end])
+        new_start, new_end = indptr[first_object], indptr[last_object]
+
+        indices[new_start:new_end] = graph.indices[edges]
+        dst[new_start:new_end] = graph.dst[edges]
+        points[new_start:new_end] = graph.points[edges]
+        reverse[new_start:new_end] = position[np.asarray(graph.reverse[edges])]
+
+    for array in (indices, dst, points, reverse):
+        array.flush()
+    del position, indices, dst, points, reverse
+    os.remove(os.path.join(tmp_folder, "position.npy"))
+
+    return _replace_graph(tmp_folder, folder)
+
+
+def closest_edges_on_disk(folder, graph, k, chunk_size=10000000):
+    """
+    Get whether every edge is one of the k closest edges of both of its objects
+    like closest_edges, stored in folder and returned as a memory map
+    """
+    def closest_of_source(sources, start, end):
+        order = np.lexsort((np.arange(end - start), graph.dst[start:end], sources))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - (graph.indptr[sources[order]] - start)
+        return rank < k
+
+    closest = edge_mask_on_disk(os.path.join(folder, "closest_source.bin"), graph, chunk_size,
+                                closest_of_source)
+    return edge_mask_on_disk(os.path.join(folder, "closest.bin"), graph, chunk_size,
+                             lambda sources, start, end: (
+                                 closest[start:end] & closest[np.asarray(graph.reverse[start:end])]))
+
+
+def edge_mask_on_disk(path, graph, chunk_size, select):
+    """
+    Get a boolean of every edge from select(sources, start, end), which gets the
+    edges start:end of a chunk of objects and their sources, stored in path and
+    returned as a memory map
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        for first_object, last_object in _object_chunks(graph.indptr, chunk_size):
+            start, end = graph.indptr[first_object], graph.indptr[last_object]
+            sources = np.repeat(np.arange(first_object, last_object),
+                                np.diff(graph.indptr[first_object:last_object + 1]))
+            f.write(np.asarray(select(sources, start, end), dtype=bool).tobytes())
+    os.replace(path + ".tmp", path)
+
+    return _read_unsorted(path, np.bool_, 1, len(graph.indices))
+
+
+def edge_sources_on_disk(folder, graph, chunk_size=10000000):
+    """
+    Get the object of which every edge starts like edge_sources, stored in
+    folder and returned as a memory map
+    """
+    path = os.path.join(folder, "sources.bin")
+    os.makedirs(folder, exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        for first_object, last_object in _object_chunks(graph.indptr, chunk_size):
+            sources = np.repeat(np.arange(first_object, last_object, dtype=np.int64),
+                                np.diff(graph.indptr[first_object:last_object + 1]))
+            f.write(sources.tobytes())
+    os.replace(path + ".tmp", path)
+
+    return _read_unsorted(path, np.int64, 1, len(graph.indices))
+
+
+def viable_edges_on_disk(folder, graph, chunk_size=10000000):
+    """
+    Get the edges with a positive distance to the intersection in CSR form like
+    viable_edges, with the edges stored in folder and returned as a memory map
+    """
+    return _select_edges(os.path.join(folder, "viable.bin"), graph, chunk_size,
+                         lambda first_object, last_object, start, end: graph.dst[start:end] > 0)
+
+
+def intersection_edges_on_disk(folder, graph, chunk_size=10000000):
+    """
+    Get every intersection once like intersection_edges, stored in folder and
+    returned as a memory map
+    """
+    def select(first_object, last_object, start, end):
+        sources = np.repeat(np.arange(first_object, last_object),
+                            np.diff(graph.indptr[first_object:last_object + 1]))
+        targets = np.asarray(graph.indices[start:end])
+        reverse = np.asarray(graph.reverse[start:end])
+        return (sources < targets) & ((graph.dst[start:end] > 0) | (graph.dst[reverse] > 0))
+
+    return _select_edges(os.path.join(folder, "intersections.bin"), graph, chunk_size,
+                         select)[1]
+
+
+def matching_classes_on_disk(folder, graph, edges, seed, chunk_size=10000000):
+    """
+    Split the edges into classes of which no two edges share an object like
+    matching_classes, with the same classes, stored in folder and returned as
+    memory maps. Every round passes over the remaining edges twice per chunk,
+    to find the lowest priority of every object and to select the edges.
+    """
+    num_objects = len(graph.indptr) - 1
+    path = os.path.join(folder, "classes.bin")
+    remaining_path = os.path.join(folder, "remaining.bin")
+    os.makedirs(folder, exist_ok=True)
+    random_state = np.random.RandomState(seed % 2**32)
+
+    def chunks(remaining, key):
+        for start in range(0, len(remaining), chunk_size):
+            chunk = np.array(remaining[start:start + chunk_size])
+            sources = np.searchsorted(graph.indptr, chunk, side="right") - 1
+            targets = np.asarray(graph.indices[chunk])
+            yield chunk, sources, targets, matching_priorities(chunk, key, len(graph.indices))
+
+    sizes = []
+    remaining = edges
+    with open(path + ".tmp", "wb") as classes_file:
+        while len(remaining):
+            key = random_state.randint(2**62)
+            lowest = np.full(num_objects, np.iinfo(np.int64).max)
+            for chunk, sources, targets, priority in chunks(remaining, key):
+                np.minimum.at(lowest, sources, priority)
+                np.minimum.at(lowest, targets, priority)
+
+            # The selected edges are appended as the next class, the others remain
+            size = 0
+            with open(remaining_path + ".tmp", "wb") as remaining_file:
+                for chunk, sources, targets, priority in chunks(remaining, key):
+                    selected = (priority == lowest[sources]) & (priority == lowest[targets])
+                    classes_file.write(chunk[selected].tobytes())
+                    remaining_file.write(chunk[~selected].tobytes())
+                    size += int(np.count_nonzero(selected))
+            os.replace(remaining_path + ".tmp", remaining_path)
+            remaining = _read_unsorted(remaining_path, np.int64, 1, len(remaining) - size)
+            sizes.append(size)
+    os.replace(path + ".tmp", path)
+    if os.path.isfile(remaining_path):
+        os.remove(remaining_path)
+
+    bounds = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=bounds[1:])
+    classes = _read_unsorted(path, np.int64, 1, int(bounds[-1]))
+    return [classes[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _select_edges(path, graph, chunk_size, select):
+    """
+    Write the edges for which select(first_object, last_object, start, end) is
+    True to path, per chunk of objects, and get them in CSR form with the edges
+    as a memory map
+    """
+    num_objects = len(graph.indptr) - 1
+    counts = np.zeros(num_objects, dtype=np.int64)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        for first_object, last_object in _object_chunks(graph.indptr, chunk_size):
+            start, end = graph.indptr[first_object], graph.indptr[last_object]
+            edges = start + np.flatnonzero(select(first_object, last_object, start, end))
+            counts[first_object:last_object] = np.diff(
+                np.searchsorted(edges, graph.indptr[first_object:last_object + 1]))
+            f.write(edges.astype(np.int64).tobytes())
+    os.replace(path + ".tmp", path)
+
+    indptr = np.zeros(num_objects + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, _read_unsorted(path, np.int64, 1, int(indptr[-1]))
+
+
+def _create(folder, name, dtype, shape):
+    """
+    Create a .npy file in folder as a writable memory map
+    """
+    return np.lib.format.open_memmap(os.path.join(folder, name + ".npy"), mode="w+",
+                                     dtype=dtype, shape=shape)
+
+
+def _replace_graph(tmp_folder, folder):
+    """
+    Replace the graph of a previous run by the graph in tmp_folder at once
+    """
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+
+    return load_graph(folder)
+
+
+def _read_unsorted(path, dtype, width, num_edges):
+    """
+    Open a file of num_edges raw values, such as an unsorted file of pass 1,
+    as a memory map
+    """
+    shape = (num_edges, width) if width > 1 else (num_edges,)
+    if num_edges == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def _object_chunks(indptr, chunk_size):
+    """
+    Split the objects into ranges of which the edges fit in one chunk, except
+    for a single object with more edges than that
+    """
+    num_objects = len(indptr) - 1
+    first_object = 0
+    while first_object < num_objects:
+        last_object = int(np.searchsorted(indptr, indptr[first_object] + chunk_size,
+                                          side="right")) - 1
+        last_object = min(max(last_object, first_object + 1), num_objects)
+        yield first_object, last_object
+        first_object = last_object
@@ -0,0 +1,189 @@
+"""
+Sparse representation of the pairwise intersections between detected objects.
+Only the admissible intersections are stored, so memory scales with the number
+of intersections instead of with the squared number of detected objects.
+"""
+from collections import namedtuple
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Every admissible intersection of objects i and j is stored as two directed
+# edges, in compressed sparse row (CSR) order. The edges of object i are found
+# at indptr[i]:indptr[i + 1], with the other object in indices, the distance
+# from the camera of object i to the intersection in dst, the RD-coordinates of
+# the intersection in points and the position of the opposite edge in reverse.
+IntersectionGraph = namedtuple("IntersectionGraph",
+                               ["indptr", "indices", "dst", "points", "reverse"])
+
+
+def build_graph(num_objects, pairs, dst_1, dst_2, points):
+    """
+    Build the sparse graph from the pairs (i, j) of intersecting objects, the
+    distances to the intersection from both cameras and the intersection points
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    num_pairs = len(pairs)
+
+    sources = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    targets = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    dst = np.concatenate((np.asarray(dst_1, dtype=float),
+                          np.asarray(dst_2, dtype=float)))
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    points = np.concatenate((points, points))
+
+    # The edge k and the edge k + num_pairs are each other's opposite
+    twin = np.concatenate((np.arange(num_pairs) + num_pairs, np.arange(num_pairs)))
+
+    order = np.lexsort((targets, sources))
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+
+    indptr = np.zeros(num_objects + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=num_objects), out=indptr[1:])
+
+    return IntersectionGraph(indptr, targets[order], dst[order], points[order],
+                             position[twin[order]])
+
+
+
+def viable_edges(graph):
+    """
+    Get the edges with a positive distance to the intersection in CSR form, the
+    viable edges of object i are edges[indptr[i]:indptr[i + 1]]
+    """
+    num_objects = len(graph.indptr) - 1
+    edges = np.flatnonzero(graph.dst > 0)
+    sources = np.searchsorted(graph.indptr, edges, side="right") - 1
+
+    indptr = np.zeros(num_objects + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=num_objects), out=indptr[1:])
+
+    return indptr, edges
+
+
+def graph_components(graph):
+    """
+    Get the connected components of the graph, as the number of components and
+    the component label of every object
+    """
+    num_objects = len(graph.indptr) - 1
+    adjacency = csr_matrix((np.ones(len(graph.indices), dtype=np.uint8),
+                            graph.indices, graph.indptr), shape=(num_objects, num_objects))
+    return connected_components(adjacency, directed=False)
+
+
+def subgraph(graph, objects):
+    """
+    Get the graph of a sorted array of objects that includes every neighbor of
+    its objects, such as a connected component. Also returns the positions of
+    the edges of the subgraph in the original graph.
+    """
+    starts, ends = graph.indptr[objects], graph.indptr[objects + 1]
+    degrees = ends - starts
+
+    indptr = np.zeros(len(objects) + 1, dtype=np.int64)
+    np.cumsum(degrees, out=indptr[1:])
+
+    # Positions of the edges of all rows of the objects, in order
+    edges = np.arange(indptr[-1]) + np.repeat(starts - indptr[:-1], degrees)
+
+    return IntersectionGraph(indptr, np.searchsorted(objects, graph.indices[edges]),
+                             graph.dst[edges], graph.points[edges],
+                             np.searchsorted(edges, graph.reverse[edges])), edges
+
+
+def edge_sources(graph):
+    """
+    Get the object of which every edge starts
+    """
+    num_objects = len(graph.indptr) - 1
+    return np.repeat(np.arange(num_objects), np.diff(graph.indptr))
+
+
+def intersection_edges(graph):
+    """
+    Get every intersection once, by its edge from the object with the lower
+    index, if it has a positive distance from at least one of both cameras
+    """
+    sources = edge_sources(graph)
+    return np.flatnonzero((sources < graph.indices)
+                          & ((graph.dst > 0) | (graph.dst[graph.reverse] > 0)))
+
+
+def matching_classes(graph, edges, seed):
+    """
+    Split the edges into classes of which no two edges share an object, so the
+    edges of one class can be changed independently. Every round the edges that
+    have the lowest random priority of all remaining edges of both of their
+    objects form the next class, as in Luby's algorithm. Returns the classes as
+    arrays of edges.
+    """
+    num_objects = len(graph.indptr) - 1
+    sources = np.searchsorted(graph.indptr, edges, side="right") - 1
+    targets = graph.indices[edges]
+    random_state = np.random.RandomState(seed % 2**32)
+
+    classes = []
+    remaining = np.arange(len(edges))
+    while len(remaining):
+        priority = matching_priorities(edges[remaining], random_state.randint(2**62),
+                                       len(graph.indices))
+        lowest = np.full(num_objects, np.iinfo(np.int64).max)
+        np.minimum.at(lowest, sources[remaining], priority)
+        np.minimum.at(lowest, targets[remaining], priority)
+
+        selected = ((priority == lowest[sources[remaining]])
+                    & (priority == lowest[targets[remaining]]))
+        classes.append(edges[remaining[selected]])
+        remaining = remaining[~selected]
+
+    return classes
+
+
+def matching_priorities(edges, key, num_edges):
+    """
+    Get the random priorities of the edges in a round of matching_classes, a
+    hash (splitmix64) of every edge and the key of the round, so they do not
+    depend on the order or the chunks in which the edges are processed. The
+    low bits are the edge itself, so no two edges have the same priority.
+    """
+    bits = np.uint64(max(int(num_edges).bit_length(), 1))
+    with np.errstate(over="ignore"):
+        z = np.asarray(edges).astype(np.uint64) + np.uint64(key) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z ^= z >> np.uint64(31)
+    return ((z >> (bits + np.uint64(1))) << bits).astype(np.int64) + edges
+
+
+def prune_graph(graph, keep):
+    """
+    Get the graph without the edges of which keep is False, keep has to be
+    the same for every edge and its opposite edge
+    """
+    num_objects = len(graph.indptr) - 1
+    edges = np.flatnonzero(keep)
+
+    indptr = np.zeros(num_objects + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edge_sources(graph)[edges], minlength=num_objects), out=indptr[1:])
+
+    # New position of every kept edge
+    position = np.cumsum(keep, dtype=np.int64) - 1
+
+    return IntersectionGraph(indptr, graph.indices[edges], graph.dst[edges],
+                             graph.points[edges], position[graph.reverse[edges]])
+
+
+def closest_edges(graph, k):
+    """
+    Get whether every edge is one of the k edges of its object with the smallest
+    distance to the intersection, for both of its objects
+    """
+    sources = edge_sources(graph)
+    order = np.lexsort((np.arange(len(sources)), graph.dst, sources))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - graph.indptr[sources[order]]
+
+    closest = rank < k
+    return closest & closest[graph.reverse]
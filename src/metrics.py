@@ -0,0 +1,159 @@
+"""
+Instrumentation of the pipeline stages: the wall time, CPU time and peak memory
+of every stage and the counters recorded while it runs are written as one JSON
+line per stage, and every stage can be profiled with cProfile. Everything is
+switched on with environment variables, so production runs can be measured
+without editing code:
+
+    GEOLOC_METRICS_FILE=output/metrics.jsonl GEOLOC_PROFILER=cprofile python3 main.py
+
+The peak memory of a stage is the high-water mark of the resident set size
+since the stage started (peak_rss_mb), which Linux resets through
+/proc/self/clear_refs. Elsewhere only the peak of the whole process so far
+is known, which is written as process_peak_rss_mb instead.
+
+Sampling profilers such as py-spy attach to the running process and need no
+support here.
+"""
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import resource
+import time
+
+METRICS_FILE = os.environ.get("GEOLOC_METRICS_FILE")  # JSON lines file of the stage metrics (None disables)
+PROFILER = os.environ.get("GEOLOC_PROFILER")  # "cprofile" to profile every stage (None disables)
+PROFILE_FOLDER = os.environ.get("GEOLOC_PROFILE_FOLDER", "output/profiles/")  # Folder for the .prof files
+
+_run = "{}_{}".format(time.strftime("%Y%m%d_%H%M%S"), os.getpid())
+_stages = []
+_profiles = 0
+_stage_peaks = True  # False once the high-water mark turns out not to be resettable
+
+
+def enabled():
+    """
+    Check if the stage metrics or the profiles are recorded
+    """
+    return bool(METRICS_FILE or PROFILER)
+
+
+def _usage():
+    """
+    Get the CPU time of this process and of its finished child processes
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+def peak_rss():
+    """
+    Get the high-water mark of the resident set size since the last reset, or
+    of the whole process if it cannot be reset (in MB)
+    """
+    if _stage_peaks:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def reset_peak_rss():
+    """
+    Reset the high-water mark of the resident set size to the current size
+    """
+    global _stage_peaks
+    if _stage_peaks:
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            _stage_peaks = False
+
+
+@contextmanager
+def stage(name):
+    """
+    Measure a pipeline stage, usable as a with-statement and as a decorator.
+    A nested stage is measured separately and is not part of the profile of
+    the enclosing stage.
+    """
+    global _profiles
+    if not enabled():
+        yield
+        return
+
+    current = {"stage": name, "counters": {}, "profile": None, "peak_rss": 0.}
+    if PROFILER:
+        if PROFILER != "cprofile":
+            raise ValueError("Unknown profiler: {}".format(PROFILER))
+        if _stages and _stages[-1]["profile"] is not None:
+            _stages[-1]["profile"].disable()
+        current["profile"] = cProfile.Profile()
+
+    # The peak of the enclosing stage so far is kept before the reset
+    if _stages:
+        _stages[-1]["peak_rss"] = max(_stages[-1]["peak_rss"], peak_rss())
+    reset_peak_rss()
+    _stages.append(current)
+
+    wall = time.perf_counter()
+    cpu, children_cpu = _usage()
+    if current["profile"] is not None:
+        current["profile"].enable()
+    try:
+        yield
+    finally:
+        if current["profile"] is not None:
+            current["profile"].disable()
+        end_cpu, end_children_cpu = _usage()
+        peak = max(current["peak_rss"], peak_rss())
+        _stages.pop()
+        if _stages:
+            _stages[-1]["peak_rss"] = max(_stages[-1]["peak_rss"], peak)
+            if _stages[-1]["profile"] is not None:
+                _stages[-1]["profile"].enable()
+
+        if current["profile"] is not None:
+            os.makedirs(PROFILE_FOLDER, exist_ok=True)
+            _profiles += 1
+            current["profile"].dump_stats(os.path.join(
+                PROFILE_FOLDER, "{}_{:03d}_{}.prof".format(_run, _profiles, name)))
+
+        if METRICS_FILE:
+            _write({"run": _run, "stage": name,
+                    "parent": _stages[-1]["stage"] if _stages else None,
+                    "wall_time": round(time.perf_counter() - wall, 6),
+                    "cpu_time": round(end_cpu - cpu, 6),
+                    "children_cpu_time": round(end_children_cpu - children_cpu, 6),
+                    "peak_rss_mb" if _stage_peaks else "process_peak_rss_mb": round(peak, 1),
+                    "counters": current["counters"]})
+
+
+def count(name, value=1):
+    """
+    Add to a counter of the current stage
+    """
+    if _stages:
+        counters = _stages[-1]["counters"]
+        counters[name] = counters.get(name, 0) + value
+
+
+def record(name, value):
+    """
+    Set a value (e.g. a list of per-iteration counts) of the current stage
+    """
+    if _stages:
+        _stages[-1]["counters"][name] = value
+
+
+def _write(line):
+    """
+    Append a JSON line to METRICS_FILE
+    """
+    if os.path.dirname(METRICS_FILE):
+        os.makedirs(os.path.dirname(METRICS_FILE), exist_ok=True)
+    with open(METRICS_FILE, "a") as f:
+        # NumPy scalars and arrays are written as plain numbers and lists
+        f.write(json.dumps(line, default=lambda value: value.tolist()) + "\n")
@@ -0,0 +1,92 @@
+"""
+Cache of panoramic image metadata from the panorama API, with an in-process
+LRU front and a persistent SQLite store, so reprocessing runs do not request
+the same panoramic image twice.
+"""
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Returned by PanoCache.get for panoramic images that are not cached, to tell
+# them apart from panoramic images that are cached as not found (None)
+MISSING = object()
+
+class PanoCache:
+    """
+    Metadata cache keyed by pano_id. The metadata None marks a panoramic image
+    that the API did not find. Entries older than ttl seconds are treated as
+    missing, a ttl of None keeps them forever. A path of None disables the
+    persistent store.
+    """
+
+    def __init__(self, path, ttl=None, lru_size=10000):
+        self.path = path
+        self.ttl = ttl
+        self.lru_size = lru_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def _db(self):
+        """
+        Get the SQLite connection of this process, forked workers open their own
+        """
+        if self._connection is None or self._pid != os.getpid():
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60,
+                                               check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS panoramas ("
+                                     "pano_id TEXT PRIMARY KEY, metadata TEXT, fetched REAL)")
+            self._pid = os.getpid()
+        return self._connection
+
+    def _expired(self, fetched):
+        return self.ttl is not None and time.time() - fetched > self.ttl
+
+    def get(self, pano_id, default=None):
+        """
+        Get the cached metadata of a panoramic image, or default if it is not
+        cached
+        """
+        with self._lock:
+            if pano_id in self._lru:
+                metadata, fetched = self._lru[pano_id]
+                if not self._expired(fetched):
+                    self._lru.move_to_end(pano_id)
+                    return metadata
+                del self._lru[pano_id]
+
+            if self.path is None:
+                return default
+            row = self._db().execute("SELECT metadata, fetched FROM panoramas WHERE pano_id = ?",
+                                     (pano_id,)).fetchone()
+            if row is None or self._expired(row[1]):
+                return default
+            metadata = json.loads(row[0])
+            self._remember(pano_id, metadata, row[1])
+            return metadata
+
+    def put(self, pano_id, metadata):
+        """
+        Store the metadata of a panoramic image, or None if it is not found
+        """
+        fetched = time.time()
+        with self._lock:
+            self._remember(pano_id, metadata, fetched)
+            if self.path is None:
+                return
+            with self._db() as connection:
+                connection.execute("INSERT OR REPLACE INTO panoramas VALUES (?, ?, ?)",
+                                   (pano_id, json.dumps(metadata), fetched))
+
+    def _remember(self, pano_id, metadata, fetched):
+        self._lru[pano_id] = (metadata, fetched)
+        self._lru.move_to_end(pano_id)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
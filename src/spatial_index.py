@@ -0,0 +1,63 @@
+"""
+Spatial indexing of camera locations and intersections, used to find the pairs
+of points that are close to each other without comparing every point with every
+other one.
+"""
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+
+def camera_pairs(cam_x, cam_y, min_dst, max_dst):
+    """
+    Get all index pairs (i < j) of camera locations that are at least min_dst
+    and at most max_dst meters apart, sorted by i and then by j.
+    Returns the pairs as an (M, 2) integer array and their distances.
+    """
+    cam_x = np.asarray(cam_x, dtype=float)
+    cam_y = np.asarray(cam_y, dtype=float)
+    if len(cam_x) < 2:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0)
+
+    tree = cKDTree(np.column_stack((cam_x, cam_y)))
+
+    # Query with a tiny margin, the exact distance test is done below
+    pairs = tree.query_pairs(max_dst * (1 + 1e-9), output_type="ndarray")
+    pairs = pairs.astype(np.int64).reshape(-1, 2)
+
+    # Order the pairs the same way as a nested loop over i and j would
+    pairs.sort(axis=1)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    cam_dst = np.sqrt((cam_y[pairs[:, 0]] - cam_y[pairs[:, 1]])**2
+                      + (cam_x[pairs[:, 0]] - cam_x[pairs[:, 1]])**2)
+    admissible = (cam_dst >= min_dst) & (cam_dst <= max_dst)
+
+    return pairs[admissible], cam_dst[admissible]
+
+
+def single_linkage_clusters(points, max_dst):
+    """
+    Get the cluster label of every point for single-linkage hierarchical
+    clustering cut at a distance of max_dst. These clusters are the connected
+    components of the pairs of points within max_dst, so there is no need for
+    the full O(M^2) distance matrix. Clusters are numbered by their first point.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    tree = cKDTree(points)
+    pairs = tree.query_pairs(max_dst * (1 + 1e-9), output_type="ndarray")
+    pairs = pairs.astype(np.int64).reshape(-1, 2)
+
+    dst = np.sqrt((points[pairs[:, 0], 0] - points[pairs[:, 1], 0])**2
+                  + (points[pairs[:, 0], 1] - points[pairs[:, 1], 1])**2)
+    pairs = pairs[dst <= max_dst]
+
+    adjacency = coo_matrix((np.ones(len(pairs), dtype=np.uint8), (pairs[:, 0], pairs[:, 1])),
+                           shape=(len(points), len(points)))
+    _, labels = connected_components(adjacency, directed=False)
+
+    return labels
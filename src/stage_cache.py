@@ -0,0 +1,46 @@
+"""
+On-disk cache of the intermediate results of the pipeline stages. Every result
+is a namedtuple of NumPy arrays, stored as one .npy file per field so it can be
+loaded back as memory maps without parsing or computing anything.
+"""
+import hashlib
+import os
+import shutil
+import numpy as np
+
+
+def cache_key(input_file, *params):
+    """
+    Get a key from the contents of the input file and the stage parameters
+    """
+    digest = hashlib.sha1()
+    with open(input_file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(repr(params).encode())
+    return digest.hexdigest()
+
+
+def cached_stage(cache_folder, stage, key, container, compute, *args):
+    """
+    Load the result of a pipeline stage from the cache, or compute it with
+    compute(*args) and store it in the cache
+    """
+    stage_folder = os.path.join(cache_folder, "{}_{}".format(stage, key))
+
+    if os.path.isdir(stage_folder):
+        print("Loaded {} from the cache: {}".format(stage, stage_folder))
+        return container._make(np.load(os.path.join(stage_folder, field + ".npy"),
+                                       mmap_mode="r") for field in container._fields)
+
+    result = compute(*args)
+
+    # Write to a temporary folder first, so only complete results are loaded
+    tmp_folder = stage_folder + ".tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+    for field, values in zip(container._fields, result):
+        np.save(os.path.join(tmp_folder, field + ".npy"), np.asarray(values))
+    os.replace(tmp_folder, stage_folder)
+
+    return result
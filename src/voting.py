@@ -0,0 +1,139 @@
+"""
+Fast localization of the objects by ray voting, an alternative to the MRF-based
+triangulation for quick previews. Every line from a camera through a detected
+object votes for the cells of a sparse grid over the RD-coordinates that it
+crosses, once per camera, and the local maxima of the votes are the objects.
+It takes time linear in the number of detected objects and the line length.
+"""
+import numpy as np
+
+from src.detections import group_cameras
+
+
+def ray_voting(objects_base, max_dst, cell_size=0.5, min_views=2, chunk_size=20000):
+    """
+    Locate the objects by ray voting. The lines run from the camera up to max_dst
+    times the distance to the normalized object location, like the intersections
+    of the MRF, and vote for the grid cells of cell_size meters. A cell that is
+    a local maximum of its 3x3 neighborhood with at least min_views votes is an
+    object, located at the vote-weighted center of that neighborhood. The lines
+    are rasterized per chunk of about chunk_size detected objects, in the order
+    of the camera x-coordinates, so only the votes of a strip of the grid that
+    the remaining lines can still reach are kept in memory. Returns the
+    objects like the clusters of the MRF: the x and y coordinates times the
+    score, and the score (the number of cameras that voted for it).
+    """
+    cameras = group_cameras(objects_base)
+    ray_x = objects_base.x_norm - objects_base.x
+    ray_y = objects_base.y_norm - objects_base.y
+    if len(ray_x) == 0:
+        return np.zeros((0, 3))
+
+    # Sample every line at half the cell size
+    lengths = np.hypot(ray_x, ray_y)
+    num_samples = np.ceil(max_dst * lengths / (cell_size / 2)).astype(np.int64)
+    steps = max_dst / num_samples
+
+    # Grid around all lines, with a margin of one cell so neighbors never wrap
+    reach = max_dst * lengths.max() + cell_size
+    origin_x, origin_y = cameras.x.min() - reach, cameras.y.min() - reach
+    num_rows = int(np.ceil((cameras.y.max() + reach - origin_y) / cell_size)) + 1
+    num_columns = int(np.ceil((cameras.x.max() + reach - origin_x) / cell_size)) + 1
+    num_cells = num_columns * num_rows
+
+    # The cameras are sorted by their x-coordinate (see group_cameras)
+    keys, votes = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    located, evaluated = [], 0
+    for first_camera, last_camera in _camera_chunks(cameras.indptr, chunk_size):
+        objects = cameras.objects[cameras.indptr[first_camera]:cameras.indptr[last_camera]]
+        camera = np.repeat(np.arange(last_camera - first_camera),
+                           np.diff(cameras.indptr[first_camera:last_camera + 1]))
+
+        # Points halfway every step along the lines
+        samples = num_samples[objects]
+        sample_object = np.repeat(objects, samples)
+        step = np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)
+        t = (step + 0.5) * steps[sample_object]
+        column = ((objects_base.x[sample_object] + t * ray_x[sample_object] - origin_x)
+                  // cell_size).astype(np.int64)
+        row = ((objects_base.y[sample_object] + t * ray_y[sample_object] - origin_y)
+               // cell_size).astype(np.int64)
+
+        # Every camera votes once for a cell, even if several of its lines cross it.
+        # Consecutive samples of a line mostly fall in the same cell, these are
+        # dropped before sorting.
+        camera_cells = np.repeat(camera, samples) * num_cells + column * num_rows + row
+        camera_cells = _sorted_unique(camera_cells[np.r_[True,
+                                                         camera_cells[1:] != camera_cells[:-1]]])
+        chunk_keys, chunk_votes = np.unique(camera_cells % num_cells, return_counts=True)
+
+        keys, inverse = np.unique(np.concatenate((keys, chunk_keys)), return_inverse=True)
+        votes = np.bincount(inverse.reshape(-1), weights=np.concatenate((votes, chunk_votes)),
+                            minlength=len(keys)).astype(np.int64)
+
+        # The columns left of the lines of the remaining cameras get no more
+        # votes, the cells of which all neighbors are final are evaluated
+        if last_camera < len(cameras.x):
+            final = int((cameras.x[last_camera] - reach - origin_x) // cell_size) - 1
+        else:
+            final = num_columns
+        start, end = np.searchsorted(keys, [evaluated * num_rows, final * num_rows])
+        located.append(_local_maxima(keys, votes, start + np.flatnonzero(votes[start:end] >= min_views),
+                                     num_rows, origin_x, origin_y, cell_size))
+        evaluated = max(evaluated, final)
+
+        # Only keep the cells that are neighbors of the cells to evaluate
+        keep = np.searchsorted(keys, (evaluated - 1) * num_rows)
+        keys, votes = keys[keep:], votes[keep:]
+
+    return np.concatenate(located)
+
+
+def _local_maxima(keys, votes, candidates, num_rows, origin_x, origin_y, cell_size):
+    """
+    Get the candidate cells that are a local maximum of the votes of their 3x3
+    neighborhood, ties are won by the cell with the lower key, at the
+    vote-weighted center of the neighborhood, as (x * score, y * score, score)
+    """
+    candidate_keys, score = keys[candidates], votes[candidates]
+    maximum = np.ones(len(candidates), dtype=bool)
+    sum_x, sum_y, sum_votes = (np.zeros(len(candidates)) for _ in range(3))
+    for offset in [dx * num_rows + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)]:
+        neighbors = candidate_keys + offset
+        positions = np.minimum(np.searchsorted(keys, neighbors), len(keys) - 1)
+        neighbor_votes = np.where(keys[positions] == neighbors, votes[positions], 0)
+
+        if offset != 0:
+            maximum &= (score > neighbor_votes) | ((score == neighbor_votes) & (offset > 0))
+
+        # Centers of the neighboring cells, weighted by their votes
+        sum_x += neighbor_votes * (origin_x + (neighbors // num_rows + 0.5) * cell_size)
+        sum_y += neighbor_votes * (origin_y + (neighbors % num_rows + 0.5) * cell_size)
+        sum_votes += neighbor_votes
+
+    score = score[maximum]
+    return np.column_stack((sum_x[maximum] / sum_votes[maximum] * score,
+                            sum_y[maximum] / sum_votes[maximum] * score, score))
+
+
+def _sorted_unique(values):
+    """
+    Get the sorted unique values of an integer array
+    """
+    values = np.sort(values)
+    return values[np.r_[True, values[1:] != values[:-1]]] if len(values) else values
+
+
+def _camera_chunks(indptr, chunk_size):
+    """
+    Split the cameras into ranges of about chunk_size detected objects, so the
+    objects of one camera are always in the same chunk
+    """
+    num_cameras = len(indptr) - 1
+    first_camera = 0
+    while first_camera < num_cameras:
+        last_camera = int(np.searchsorted(indptr, indptr[first_camera] + chunk_size,
+                                          side="right")) - 1
+        last_camera = min(max(last_camera, first_camera + 1), num_cameras)
+        yield first_camera, last_camera
+        first_camera = last_camera